@@ -1,7 +1,7 @@
 import arcpy
 import os
 from PNET_Functions import get_watershed_folders, delete_old, create_csv,\
-    get_fields, csv_to_list, parse_multistring, make_folder, finish
+    get_fields, csv_to_list, parse_multistring, make_folder, finish, load_field_database
 
 
 # -------------------------------------------------------------------------------
@@ -38,7 +38,7 @@ def main():
         if field not in exist_fields and field is not "":
             print("[{}] PNET field is missing from {}".format(field, projectwide_input))
 
-    exist_fields = get_fields(field_db)
+    exist_fields = load_field_database(field_db)["fields"]
 
     for field in set(field_db_fields):
         if field not in exist_fields and field is not "":
@@ -2,6 +2,12 @@ import arcpy
 import os
 import shutil
 import csv
+import math
+import hashlib
+import heapq
+import array
+import pickle
+import numpy as np
 
 # -------------------------------------------------------------------------------
 # Name:        PNET_Functions
@@ -243,5 +249,1275 @@ def csv_to_list(csv_to_read):
     return data
 
 
+def csv_headers(csv_to_read):
+    # Reads only the first row of a CSV
+    with open(csv_to_read, 'r') as f:
+        return next(csv.reader(f, delimiter=','), [])
+
+
+def list_to_csv(output_csv, data):
+
+    # Writes a list of rows (headers first) into a CSV
+    with open(output_csv, "w") as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=',', lineterminator='\n')
+        for row in data:
+            csvwriter.writerow(row)
+    return output_csv
+
+
+def get_attribute_fields(shapefile):
+    # Gets every field name, other than the object ID and geometry fields
+    return [f.name for f in arcpy.ListFields(shapefile) if f.type not in ["OID", "Geometry"]]
+
+
+def create_output(out_features, geometry_type, template, add_fields=None, spatial_reference=None):
+
+    # Creates an empty shapefile with the same fields and spatial reference as the template. Without a template, the
+    # shapefile only has the added fields, and the spatial reference must be given.
+    if add_fields is None:
+        add_fields = []
+    if template is None and geometry_type == "POINT":
+        return create_points(out_features, add_fields, spatial_reference)
+
+    out_folder, out_name = os.path.split(out_features)
+    arcpy.CreateFeatureclass_management(out_folder, out_name, geometry_type, template,
+                                        spatial_reference=spatial_reference or template)
+    # Each added field is [name, type], or [name, type, length] for text
+    for field in add_fields:
+        arcpy.AddField_management(out_features, field[0], field[1],
+                                  field_length=field[2] if len(field) > 2 else None)
+
+    # New shapefiles are given an Id field by default
+    if template is None and "Id" not in [field[0] for field in add_fields]:
+        remove_fields(["Id"], out_features)
+    return out_features
+
+
+# A shapefile can have at most 255 fields, and create_points briefly adds two more for the coordinates
+max_point_fields = 253
+
+
+def create_points(out_features, schema, spatial_reference):
+
+    # Creates an empty point shapefile with every field in the schema at once, rather than adding them one at a time.
+    # The schema is a list of [name, type], or [name, type, length] for text.
+    if len(schema) > max_point_fields:
+        raise ValueError("{} has {} fields, but a shapefile made this way can have at most {}"
+                         .format(out_features, len(schema), max_point_fields))
+    dtype = [("PNET_X", "<f8"), ("PNET_Y", "<f8")]
+    for field_name, field in zip(get_schema_names([field[0] for field in schema]), schema):
+        dtype.append((str(field_name), get_field_dtype(*field[1:])))
+
+    if not hasattr(spatial_reference, "factoryCode"):
+        spatial_reference = arcpy.Describe(spatial_reference).spatialReference
+    if arcpy.Exists(out_features):
+        arcpy.Delete_management(out_features)
+    arcpy.da.NumPyArrayToFeatureClass(np.zeros(0, dtype=dtype), out_features, ["PNET_X", "PNET_Y"], spatial_reference)
+
+    # The coordinates are only used for the geometry, but are removed in case they were also saved as fields
+    remove_fields(["PNET_X", "PNET_Y"], out_features)
+    return out_features
+
+
+def get_field_dtype(field_type, field_length=50):
+    # The NumPy type that is saved as each type of field
+    if field_type == "TEXT":
+        return "<U{}".format(field_length)
+    return {"SHORT": "<i2", "LONG": "<i4", "FLOAT": "<f4", "DOUBLE": "<f8", "DATE": "<M8[us]"}[field_type]
+
+
+def get_schema_names(field_names, report=True):
+
+    # Shapefile field names are at most 10 characters, and can't be the same when ignoring case. Names that would be
+    # the same once shortened are given a number at the end, so that no field is lost. Set report to False when only
+    # looking up the names of an output that was already written.
+    schema_names = []
+    used = set()
+    for field_name in field_names:
+        schema_name = field_name[:10]
+        number = 0
+        while schema_name.lower() in used:
+            number += 1
+            schema_name = "{}_{}".format(field_name[:9 - len(str(number))], number)
+        if report and schema_name != field_name[:10]:
+            arcpy.AddMessage("\t\t Field {} is the same as another field in its first 10 characters, saving it as {}"
+                             .format(field_name, schema_name))
+        used.add(schema_name.lower())
+        schema_names.append(schema_name)
+    return schema_names
+
+
+def write_features(out_features, geometry_type, template, rows, add_fields=None, shape_field="SHAPE@",
+                   spatial_reference=None):
+
+    # Writes a list of rows (geometry first, then every attribute field in order) into a new shapefile at once
+    create_output(out_features, geometry_type, template, add_fields, spatial_reference)
+    fields = [shape_field] + get_attribute_fields(out_features)
+    with arcpy.da.InsertCursor(out_features, fields) as inserter:
+        for row in rows:
+            inserter.insertRow(row)
+    return out_features
+
+
+def export_features(in_features, out_features, key_field, values, keep=True):
+
+    # Saves every feature whose key field is one of the values (or, if keep is False, is not one of the values),
+    # reading and writing each feature once instead of selecting features one at a time
+    values = set(values)
+    fields = get_attribute_fields(in_features)
+    key_index = fields.index(key_field) + 1
+    with arcpy.da.SearchCursor(in_features, ["SHAPE@"] + fields) as cursor:
+        rows = [row for row in cursor if (row[key_index] in values) == keep]
+    geometry_type = arcpy.Describe(in_features).shapeType.upper()
+    write_features(out_features, geometry_type, in_features, rows)
+    return len(rows)
+
+
+def get_column_kind(field_type):
+
+    # Sorts arcpy field types into the kinds of column they are read into
+    if field_type == "String":
+        return "text"
+    if field_type in ["OID", "SmallInteger", "Integer", "Single", "Double"]:
+        return "number"
+    return "other"
+
+
+def read_columns(table, fields):
+
+    # Reads each field of a table into its own column, instead of a list of rows.
+    # Numbers: A float array, with missing values as NaN
+    # Text: Dictionary encoded, an integer code per row plus the list of distinct values (categories) the codes refer to,
+    #       so each distinct value is only stored once
+    # Anything else (including geometry tokens like SHAPE@XY): A list of the values
+    field_types = dict((field.name, field.type) for field in arcpy.ListFields(table))
+    kinds = [get_column_kind(field_types.get(field)) for field in fields]
+    values = [array.array("l") if kind == "text" else [] for kind in kinds]
+    encoders = [{} for _ in fields]
+
+    with arcpy.da.SearchCursor(table, fields) as cursor:
+        for row in cursor:
+            for count, value in enumerate(row):
+                if kinds[count] == "text":
+                    value = encoders[count].setdefault(value, len(encoders[count]))
+                values[count].append(value)
+
+    columns = []
+    for kind, column_values, encoder in zip(kinds, values, encoders):
+        if kind == "text":
+            categories = [None] * len(encoder)
+            for value, code in encoder.items():
+                categories[code] = value
+            columns.append({"kind": kind, "codes": np.array(column_values, dtype=int), "categories": categories})
+        elif kind == "number":
+            columns.append({"kind": kind, "values": np.array([np.nan if value is None else value
+                                                              for value in column_values], dtype=float)})
+        else:
+            columns.append({"kind": kind, "values": column_values})
+    return columns
+
+
+def take_column(column, index):
+
+    # Returns a column with only the given rows, in the given order
+    if column["kind"] == "text":
+        return {"kind": "text", "codes": column["codes"][index], "categories": column["categories"]}
+    if column["kind"] == "number":
+        return {"kind": "number", "values": column["values"][index]}
+    return {"kind": column["kind"], "values": [column["values"][row] for row in index]}
+
+
+def decode_column(column):
+
+    # Turns a column back into a list of values that can be written with a cursor
+    if column["kind"] == "text":
+        return [column["categories"][code] for code in column["codes"]]
+    if column["kind"] == "number":
+        return [None if np.isnan(value) else float(value) for value in column["values"]]
+    return list(column["values"])
+
+
+def get_dataset_files(shapefile):
+
+    # Lists every file that makes up a shapefile (.shp, .shx, .dbf, .prj, spatial indexes, metadata, ...)
+    extensions = [".shp", ".shx", ".dbf", ".prj", ".cpg", ".sbn", ".sbx", ".fbn", ".fbx", ".ain", ".aih", ".atx",
+                  ".ixs", ".mxs", ".qix", ".shp.xml"]
+    base = os.path.splitext(shapefile)[0]
+    return [base + extension for extension in extensions if os.path.exists(base + extension)]
+
+
+def copy_dataset(in_dataset, out_dataset):
+
+    # Saves a duplicate of a shapefile by copying the files that make it up, which is much faster than having ArcGIS
+    # copy it feature by feature. Anything that isn't a shapefile is copied by ArcGIS.
+    if not in_dataset.lower().endswith(".shp") or not out_dataset.lower().endswith(".shp"):
+        arcpy.Copy_management(in_dataset, out_dataset)
+        return out_dataset
+
+    for old_file in get_dataset_files(out_dataset):
+        os.remove(old_file)
+
+    in_base = os.path.splitext(in_dataset)[0]
+    out_base = os.path.splitext(out_dataset)[0]
+    for in_file in get_dataset_files(in_dataset):
+        shutil.copyfile(in_file, out_base + in_file[len(in_base):])
+
+    return out_dataset
+
+
+def get_field_type(shapefile, field_name):
+
+    # Returns the type of a field, in the form used to add a field
+    field_types = {"SmallInteger": "SHORT", "Integer": "LONG", "Single": "FLOAT", "Double": "DOUBLE",
+                   "String": "TEXT", "Date": "DATE"}
+    for field in arcpy.ListFields(shapefile):
+        if field.name == field_name:
+            return field_types.get(field.type, "TEXT")
+    return None
+
+
+def get_field_definitions(shapefile, field_names):
+
+    # Returns [name, type, length] for each field, so the same fields can be added to a new shapefile
+    lengths = dict((field.name, field.length) for field in arcpy.ListFields(shapefile))
+    definitions = []
+    for field_name in field_names:
+        field_type = get_field_type(shapefile, field_name)
+        if field_type == "TEXT":
+            definitions.append([field_name, field_type, lengths[field_name]])
+        else:
+            definitions.append([field_name, field_type])
+    return definitions
+
+
+def get_extent_array(geometries):
+
+    # Returns an array with the [XMin, YMin, XMax, YMax] of every geometry
+    extents = np.full((len(geometries), 4), np.nan)
+    for count, geometry in enumerate(geometries):
+        if geometry is not None:
+            extent = geometry.extent
+            extents[count] = [extent.XMin, extent.YMin, extent.XMax, extent.YMax]
+    return extents
+
+
+def overlay_lines(lines, segments):
+
+    # Finds how much of each segment overlaps each line, in one pass over the lines. The segments are indexed by their
+    # extents, so only segments whose extent overlaps a line's extent are tested.
+    # Returns arrays of the line number, segment number and overlap length in meters of every pair that overlaps.
+    line_extents = get_extent_array(lines)
+    segment_extents = get_extent_array(segments)
+
+    # Sort the segments by their left edge, so that segments starting right of a line are never looked at
+    order = np.argsort(segment_extents[:, 0], kind="mergesort")
+    sorted_x_min = segment_extents[order, 0]
+
+    line_numbers = []
+    segment_numbers = []
+    lengths = []
+
+    for line_number, line in enumerate(lines):
+        if line is None:
+            continue
+        x_min, y_min, x_max, y_max = line_extents[line_number]
+        candidates = order[:np.searchsorted(sorted_x_min, x_max, side="right")]
+        candidate_extents = segment_extents[candidates]
+        candidates = candidates[(candidate_extents[:, 2] >= x_min) & (candidate_extents[:, 1] <= y_max) &
+                                (candidate_extents[:, 3] >= y_min)]
+
+        for segment_number in np.sort(candidates):
+            overlap = line.intersect(segments[segment_number], 2).getLength("PLANAR", "METERS")
+            if overlap > 0:
+                line_numbers.append(line_number)
+                segment_numbers.append(segment_number)
+                lengths.append(overlap)
+
+    return np.array(line_numbers, dtype=int), np.array(segment_numbers, dtype=int), np.array(lengths, dtype=float)
+
+
+def build_polygon_index(polygons, cells_across=64):
+
+    # Lays a grid over a list of polygons. Each grid cell remembers the polygon that completely contains it (interior
+    # cells) and every polygon whose boundary passes through it (boundary cells). Features that only cover interior
+    # cells of a single polygon can be routed without any exact geometry tests.
+    extents = get_extent_array(polygons)
+    index = {"polygons": polygons,
+             "origin": (extents[:, 0].min(), extents[:, 1].min()),
+             "interior": {},
+             "boundary": {}}
+    width = max(extents[:, 2].max() - extents[:, 0].min(), extents[:, 3].max() - extents[:, 1].min())
+    index["cell_size"] = width / cells_across if width > 0 else 1.0
+
+    for number, (polygon, extent) in enumerate(zip(polygons, extents)):
+        for cell in get_cells(index, *extent):
+            cell_polygon = get_cell_polygon(index, cell, polygon.spatialReference)
+            if polygon.contains(cell_polygon):
+                index["interior"][cell] = number
+            elif not polygon.disjoint(cell_polygon):
+                index["boundary"].setdefault(cell, []).append(number)
+
+    return index
+
+
+def get_cells(index, x_min, y_min, x_max, y_max):
+
+    # Returns every grid cell that a bounding box touches
+    origin_x, origin_y = index["origin"]
+    size = index["cell_size"]
+    columns = range(int(math.floor((x_min - origin_x) / size)), int(math.floor((x_max - origin_x) / size)) + 1)
+    rows = range(int(math.floor((y_min - origin_y) / size)), int(math.floor((y_max - origin_y) / size)) + 1)
+    return [(column, row) for column in columns for row in rows]
+
+
+def get_cell_polygon(index, cell, spatial_reference):
+
+    # Creates a square polygon covering a single grid cell
+    origin_x, origin_y = index["origin"]
+    size = index["cell_size"]
+    x_min = origin_x + cell[0] * size
+    y_min = origin_y + cell[1] * size
+    corners = [[x_min, y_min], [x_min, y_min + size], [x_min + size, y_min + size], [x_min + size, y_min], [x_min, y_min]]
+    return arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in corners]), spatial_reference)
+
+
+def route_geometry(index, geometry):
+
+    # Finds every polygon that a geometry falls within, returned as a list of [polygon number, geometry].
+    # Lines and polygons that cross a boundary are clipped to the polygon.
+    extent = geometry.extent
+    cells = get_cells(index, extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+    interior = index["interior"]
+    boundary = index["boundary"]
+
+    # The geometry is entirely inside one polygon's interior, so no exact test is needed
+    owners = set([interior.get(cell) for cell in cells])
+    if len(owners) == 1 and None not in owners:
+        return [[owners.pop(), geometry]]
+
+    candidates = set()
+    for cell in cells:
+        if cell in interior:
+            candidates.add(interior[cell])
+        candidates.update(boundary.get(cell, []))
+
+    routed = []
+    for number in sorted(candidates):
+        polygon = index["polygons"][number]
+        if polygon.contains(geometry):
+            routed.append([number, geometry])
+        elif not polygon.disjoint(geometry):
+            # A geometry that only touches the polygon's edge has nothing inside it, so it is not sent there
+            if geometry.type == "polyline":
+                clipped = geometry.intersect(polygon, 2)
+                if clipped is not None and clipped.length > 0:
+                    routed.append([number, clipped])
+            elif geometry.type == "polygon":
+                clipped = geometry.intersect(polygon, 4)
+                if clipped is not None and clipped.area > 0:
+                    routed.append([number, clipped])
+            else:
+                # Points that sit exactly on a boundary go to every polygon they touch
+                routed.append([number, geometry])
+
+    return routed
+
+
+def partition_features(in_features, index, fields):
+
+    # Streams every feature of a dataset once, and yields [polygon number, row] for each polygon it belongs to.
+    # The first value of each row is the (possibly clipped) geometry, followed by the requested fields.
+    with arcpy.da.SearchCursor(in_features, ["SHAPE@"] + fields) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            for number, geometry in route_geometry(index, row[0]):
+                yield number, [geometry] + list(row[1:])
+
+
+def partition_to_outputs(in_features, index, outputs, geometry_type):
+
+    # Splits a dataset between polygons in a single pass, writing one output per polygon.
+    # Returns the number of features written into each output, and the extent ([XMin, YMin, XMax, YMax]) of each output.
+    for output in outputs:
+        create_output(output, geometry_type, in_features)
+
+    in_fields = get_attribute_fields(in_features)
+    out_fields = ["SHAPE@"] + get_attribute_fields(outputs[0]) if outputs else []
+    inserters = [arcpy.da.InsertCursor(output, out_fields) for output in outputs]
+    counts = [0] * len(outputs)
+    extents = [None] * len(outputs)
+
+    for number, row in partition_features(in_features, index, in_fields):
+        inserters[number].insertRow(row)
+        counts[number] += 1
+        extent = row[0].extent
+        if extents[number] is None:
+            extents[number] = [extent.XMin, extent.YMin, extent.XMax, extent.YMax]
+        else:
+            extents[number] = [min(extents[number][0], extent.XMin), min(extents[number][1], extent.YMin),
+                               max(extents[number][2], extent.XMax), max(extents[number][3], extent.YMax)]
+
+    # Release the cursors so that the outputs are no longer locked
+    del inserters[:]
+
+    return counts, extents
+
+
+def read_watershed_boundaries(watershed_folders):
+
+    # Reads the boundary of every watershed as a single polygon, in the same order as the watershed folders
+    boundaries = []
+    for watershed_folder in watershed_folders:
+        boundary = os.path.join(watershed_folder, "Inputs", "Watershed_Boundary", "Watershed_Boundary.shp")
+        with arcpy.da.SearchCursor(boundary, ["SHAPE@"]) as cursor:
+            shapes = [row[0] for row in cursor]
+        for shape in shapes[1:]:
+            shapes[0] = shapes[0].union(shape)
+        boundaries.append(shapes[0])
+    return boundaries
+
+
+def get_data_network_directory(root_folder):
+    return os.path.join(root_folder, "00_ProjectWide", "Inputs", "Data_Networks", "Data_Network_Directory.csv")
+
+
+def read_data_network_directory(root_folder):
+
+    # Reads the table Step 6 saves, which lists every data network slice along with how many features it has,
+    # its extent, and a hash of its contents
+    rows = csv_to_list(get_data_network_directory(root_folder))
+    headers = rows[0]
+    return [dict(zip(headers, row)) for row in rows[1:]]
+
+
+def get_data_network_slices(root_folder, watershed_folder, directory=None):
+
+    # Lists [network name, slice location] for every data network that has features in this watershed
+    if directory is None:
+        directory = read_data_network_directory(root_folder)
+    watershed = os.path.basename(watershed_folder)
+    return [[entry["Network"], os.path.join(watershed_folder, "Inputs", "Data_Networks", entry["Network"] + ".shp")]
+            for entry in directory if entry["Watershed"] == watershed and int(entry["Count"]) > 0]
+
+
+def load_field_database(database, cache_file=None, fields=None):
+
+    # Reads the field database into columns, with an index of which row each RchID is on. Reading a large database
+    # is slow, so it is also saved to a cache file, which is used until the database's contents change. A cache file
+    # should only ever be given one database. If fields are given, only those fields (and RchID) are kept.
+    file_stats = os.stat(database)
+    source = [file_stats.st_mtime, file_stats.st_size]
+
+    store = None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                store = pickle.load(f)
+        except Exception:
+            store = None
+
+    # Caches from before numeric columns were saved with the text are read again
+    if store is not None and store.get("format") != "typed":
+        store = None
+
+    # A database that was only copied or touched still has the same contents, so the hash is checked before reading
+    file_hash = None
+    if store is not None and store["source"] != source:
+        file_hash = get_file_hash([database])
+        if store["hash"] == file_hash:
+            store["source"] = source
+            save_field_database_cache(cache_file, store)
+        else:
+            store = None
+
+    if store is None:
+        store = read_field_database(database)
+        store["source"] = source
+        store["hash"] = file_hash or get_file_hash([database])
+        if cache_file:
+            save_field_database_cache(cache_file, store)
+
+    if fields is not None:
+        store = project_field_database(store, fields)
+    return store
+
+
+def project_field_database(store, fields):
+    # Keeps only the given fields of the field database (and RchID, which reaches are matched by)
+    kept = [field for field in store["fields"] if field in fields or field == "RchID"]
+    kept = [field for count, field in enumerate(kept) if field not in kept[:count]]
+    return {"format": store["format"], "fields": kept, "index": store["index"],
+            "numbers": dict((field, store["numbers"][field]) for field in kept if field in store["numbers"]),
+            "data": [store["columns"][field] for field in kept],
+            "columns": dict((field, store["columns"][field]) for field in kept),
+            "source": store["source"], "hash": store["hash"]}
+
+
+def save_field_database_cache(cache_file, store):
+    # Protocol 2 can be read by both Python 2 and Python 3
+    with open(cache_file, "wb") as f:
+        pickle.dump(store, f, 2)
+    return cache_file
+
+
+def read_field_database(database):
+
+    # Reads every column of a CSV as the text it was saved as, so text such as IDs with leading zeros is never changed.
+    # Every column that is all numbers (or empty) is also kept as an array of numbers, which is saved in the cache so
+    # steps that compare values do not parse them again (see get_database_numbers).
+    # Every column is kept in order, and a field that is in the database twice is looked up by its first column.
+    rows = csv_to_list(database)
+    fields = rows[0]
+    data = [[row[count] if count < len(row) else "" for row in rows[1:]] for count in range(len(fields))]
+    columns = {}
+    for field, values in zip(fields, data):
+        columns.setdefault(field, values)
+
+    # The first row of each reach is used, in case a reach is in the database more than once
+    index = {}
+    for row_num, rch_id in enumerate(columns["RchID"]):
+        index.setdefault(rch_id, row_num)
+
+    numbers = {}
+    for field, values in columns.items():
+        try:
+            numbers[field] = to_numbers(values)
+        except ValueError:
+            pass
+
+    return {"format": "typed", "fields": fields, "data": data, "columns": columns, "index": index, "numbers": numbers}
+
+
+def to_numbers(values):
+    # Turns a column of text into numbers, with NaN for empty values
+    return np.array([float(value) if value != "" else np.nan for value in values], dtype=float)
+
+
+def get_database_rows(store, rch_ids):
+    # Finds which row of the field database each reach is on, with -1 for reaches that are not in it
+    return np.array([store["index"].get(rch_id, -1) for rch_id in rch_ids], dtype=int)
+
+
+def get_database_column(store, field, rows):
+    # Gets the text of one field for the given rows. Rows of -1 are missing, and are empty.
+    values = store["columns"][field]
+    return [values[row] if row >= 0 else "" for row in rows]
+
+
+def get_database_numbers(store, field, rows):
+
+    # Gets the values of one field for the given rows as numbers, with NaN for empty values and rows of -1. A field
+    # that is not all numbers raises a ValueError.
+    if field not in store["numbers"]:
+        store["numbers"][field] = to_numbers(store["columns"][field])
+    values = store["numbers"][field]
+    rows = np.asarray(rows, dtype=int)
+    column = np.full(len(rows), np.nan)
+    found = rows >= 0
+    column[found] = values[rows[found]]
+    return column
+
+
+def save_database_subset(store, rows, save_loc):
+
+    # Saves only the given rows of the field database into a CSV, exactly as they were written in the database
+    rows = [row for row in rows if row >= 0]
+    columns = [[values[row] for row in rows] for values in store["data"]]
+    return list_to_csv(save_loc, [store["fields"]] + [list(row) for row in zip(*columns)])
+
+
+def read_network(network):
+
+    # Reads a stream network once and breaks every line into its straight segments, stored as arrays so that
+    # every segment can be searched at the same time. Each segment remembers which line (edge) it came from, and
+    # how far along that line it starts (its measure).
+    vertices = []
+    oids = []
+
+    with arcpy.da.SearchCursor(network, ["OID@", "SHAPE@"]) as cursor:
+        for oid, line in cursor:
+            oids.append(oid)
+            edge_vertices = []
+            if line is not None:
+                for part in line:
+                    for point in part:
+                        if point is not None:
+                            edge_vertices.append([point.X, point.Y])
+            vertices.append(np.array(edge_vertices, dtype=float).reshape(-1, 2))
+
+    return make_network(vertices, oids)
+
+
+def make_network(vertices, oids):
+
+    # Breaks the vertices of every line (edge) into straight segments, as read_network describes
+    segments = {"x1": [], "y1": [], "x2": [], "y2": [], "edge": [], "measure": []}
+    for edge, edge_vertices in enumerate(vertices):
+        measure = 0.0
+        for (x1, y1), (x2, y2) in zip(edge_vertices[:-1], edge_vertices[1:]):
+            segments["x1"].append(x1)
+            segments["y1"].append(y1)
+            segments["x2"].append(x2)
+            segments["y2"].append(y2)
+            segments["edge"].append(edge)
+            segments["measure"].append(measure)
+            measure += math.hypot(x2 - x1, y2 - y1)
+
+    to_return = dict((key, np.array(values, dtype=float)) for key, values in segments.items())
+    to_return["edge"] = to_return["edge"].astype(int)
+    to_return["vertices"] = vertices
+    to_return["oids"] = oids
+    return to_return
+
+
+def split_network_at_junctions(network, tolerance=0.01):
+
+    # The network graph only links lines at their ends, so a stream that joins another part way along it would not be
+    # connected. Every line is split wherever the end of another line touches it (anywhere but its own ends).
+    # Returns the split network (each piece keeps the OID of the line it came from) and how many splits were made.
+    splits = {}
+    for edge, vertices in enumerate(network["vertices"]):
+        if len(vertices) < 2:
+            continue
+        for x, y in [vertices[0], vertices[-1]]:
+            for other, measure, _, _, _ in snap_candidates(network, x, y, tolerance, len(network["vertices"])):
+                length = get_edge_measures(network["vertices"][other])[-1]
+                if other != edge and tolerance < measure < length - tolerance:
+                    splits.setdefault(other, set()).add(measure)
+
+    if not splits:
+        return network, 0
+
+    vertices = []
+    oids = []
+    for edge, edge_vertices in enumerate(network["vertices"]):
+        if edge not in splits:
+            vertices.append(edge_vertices)
+            oids.append(network["oids"][edge])
+            continue
+        measures = [0.0] + sorted(splits[edge]) + [get_edge_measures(edge_vertices)[-1]]
+        for start, end in zip(measures[:-1], measures[1:]):
+            vertices.append(np.array(get_path_vertices(network, [[edge, start, end]]), dtype=float).reshape(-1, 2))
+            oids.append(network["oids"][edge])
+
+    return make_network(vertices, oids), sum(len(measures) for measures in splits.values())
+
+
+def get_edge_measures(vertices):
+
+    # Returns how far along its edge each vertex is
+    return np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(vertices[:, 0]), np.diff(vertices[:, 1])))])
+
+
+def get_path_vertices(network, pieces):
+
+    # Turns the pieces of a network path ([edge, start measure, end measure]) into a single list of vertices,
+    # in the order they are travelled
+    path = []
+    for edge, start, end in pieces:
+        vertices = network["vertices"][edge]
+        measures = get_edge_measures(vertices)
+        low = min(start, end)
+        high = max(start, end)
+
+        # The vertices between the two measures, with the exact start and end spots added
+        inside = (measures > low) & (measures < high)
+        piece = np.vstack([[np.interp(low, measures, vertices[:, 0]), np.interp(low, measures, vertices[:, 1])],
+                           vertices[inside],
+                           [np.interp(high, measures, vertices[:, 0]), np.interp(high, measures, vertices[:, 1])]])
+        if start > end:
+            piece = piece[::-1]
+
+        for x, y in piece:
+            if not path or (x, y) != path[-1]:
+                path.append((float(x), float(y)))
+
+    return path
+
+
+def build_segment_index(network):
+
+    # Lays a grid over the network segments. Each grid cell remembers every segment whose bounding box touches it,
+    # so that a point only has to be projected onto the segments near it.
+    x_min = np.minimum(network["x1"], network["x2"])
+    y_min = np.minimum(network["y1"], network["y2"])
+    x_max = np.maximum(network["x1"], network["x2"])
+    y_max = np.maximum(network["y1"], network["y2"])
+
+    index = {"origin": (x_min.min(), y_min.min()),
+             "bounds": (x_min.min(), y_min.min(), x_max.max(), y_max.max()),
+             "cells": {}}
+    width = max(x_max.max() - x_min.min(), y_max.max() - y_min.min())
+    cells_across = max(1, int(math.sqrt(len(x_min))))
+    index["cell_size"] = width / cells_across if width > 0 else 1.0
+
+    for segment, extent in enumerate(zip(x_min, y_min, x_max, y_max)):
+        for cell in get_cells(index, *extent):
+            index["cells"].setdefault(cell, []).append(segment)
+
+    index["cells"] = dict((cell, np.array(segments, dtype=int)) for cell, segments in index["cells"].items())
+    return index
+
+
+def get_segment_index(network):
+
+    # Builds the segment grid the first time a network is searched, and keeps it with the network
+    if "index" not in network:
+        network["index"] = build_segment_index(network)
+    return network["index"]
+
+
+def get_nearby_segments(network, x, y, radius):
+
+    # Returns every segment (in order) whose bounding box comes within radius of a point. This is never missing a
+    # segment that is within radius of the point, but may include some that are further away.
+    index = get_segment_index(network)
+    bounds = index["bounds"]
+    x_min = max(x - radius, bounds[0])
+    y_min = max(y - radius, bounds[1])
+    x_max = min(x + radius, bounds[2])
+    y_max = min(y + radius, bounds[3])
+
+    if x_min > x_max or y_min > y_max:
+        return np.zeros(0, dtype=int)
+    if (x_min, y_min, x_max, y_max) == bounds:
+        return np.arange(len(network["x1"]))
+
+    found = [index["cells"][cell] for cell in get_cells(index, x_min, y_min, x_max, y_max) if cell in index["cells"]]
+    if not found:
+        return np.zeros(0, dtype=int)
+    return np.unique(np.concatenate(found))
+
+
+def project_to_segments(network, point_x, point_y, segments=None):
+
+    # Projects points onto every segment at once (or only the given segments). The points should be columns (n x 1),
+    # so that every result is an array with one row per point and one column per segment.
+    if segments is None:
+        segments = slice(None)
+    x1, y1 = network["x1"][segments], network["y1"][segments]
+    dx = network["x2"][segments] - x1
+    dy = network["y2"][segments] - y1
+    length_squared = dx * dx + dy * dy
+
+    # Zero length segments are treated as a single point
+    safe_length = np.where(length_squared > 0, length_squared, 1.0)
+
+    # How far along each segment the point projects, limited to the segment itself
+    along = np.clip(((point_x - x1) * dx + (point_y - y1) * dy) / safe_length, 0.0, 1.0)
+    close_x = x1 + along * dx
+    close_y = y1 + along * dy
+    squared = (point_x - close_x) ** 2 + (point_y - close_y) ** 2
+    measure = network["measure"][segments] + along * np.sqrt(length_squared)
+
+    return close_x, close_y, squared, measure
+
+
+def snap_to_network(network, x, y):
+
+    # Finds the exact closest point on the network for every point. Each point is only projected onto the segments
+    # near it, and the search area grows until the closest segment found is inside it, so that no closer segment
+    # can be missed. Returns the snapped x and y, the snap distance, the edge each point snapped to, and the measure
+    # along that edge.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    num_points = len(x)
+
+    snap_x = x.copy()
+    snap_y = y.copy()
+    distance = np.full(num_points, np.inf)
+    edge = np.full(num_points, -1, dtype=int)
+    measure = np.zeros(num_points)
+
+    num_segments = len(network["x1"])
+    if num_segments == 0 or num_points == 0:
+        return snap_x, snap_y, distance, edge, measure
+
+    start_radius = get_segment_index(network)["cell_size"]
+
+    for point in range(num_points):
+        radius = start_radius
+        while True:
+            segments = get_nearby_segments(network, x[point], y[point], radius)
+            if len(segments) == 0:
+                radius *= 2
+                continue
+
+            close_x, close_y, squared, along_measure = project_to_segments(network, x[point], y[point], segments)
+            best = np.argmin(squared)
+            found = math.sqrt(squared[best])
+            if found <= radius or len(segments) == num_segments:
+                break
+            radius = found
+
+        snap_x[point] = close_x[best]
+        snap_y[point] = close_y[best]
+        distance[point] = found
+        edge[point] = network["edge"][segments[best]]
+        measure[point] = along_measure[best]
+
+    return snap_x, snap_y, distance, edge, measure
+
+
+def snap_candidates(network, x, y, max_distance, max_candidates=5):
+
+    # Finds the closest spot on each of the nearest edges to a single point, as long as it is within max_distance.
+    # Returns a list of [edge, measure, snapped x, snapped y, distance], closest first.
+    if len(network["x1"]) == 0:
+        return []
+
+    segments = get_nearby_segments(network, float(x), float(y), max_distance)
+    close_x, close_y, squared, measure = project_to_segments(network, float(x), float(y), segments)
+    distance = np.sqrt(squared)
+
+    # Sort every nearby segment by distance, then keep the first (closest) segment of each edge
+    order = np.argsort(distance, kind="mergesort")
+    order = order[distance[order] <= max_distance]
+    _, first = np.unique(network["edge"][segments[order]], return_index=True)
+    closest = order[np.sort(first)][:max_candidates]
+
+    return [[int(network["edge"][segments[count]]), float(measure[count]), float(close_x[count]),
+             float(close_y[count]), float(distance[count])] for count in closest]
+
+
+def build_network_graph(network, tolerance=0.01):
+
+    # Turns the network into a graph, where every edge (line) links the two nodes at its ends.
+    # Line ends closer together than the tolerance share the same node.
+    node_ids = {}
+    edge_nodes = []
+    edge_lengths = []
+    adjacency = {}
+
+    for edge, vertices in enumerate(network["vertices"]):
+        if len(vertices) < 2:
+            edge_nodes.append([-1, -1])
+            edge_lengths.append(0.0)
+            continue
+
+        length = float(np.sum(np.hypot(np.diff(vertices[:, 0]), np.diff(vertices[:, 1]))))
+        ends = []
+        for x, y in [vertices[0], vertices[-1]]:
+            key = (int(round(x / tolerance)), int(round(y / tolerance)))
+            ends.append(node_ids.setdefault(key, len(node_ids)))
+
+        edge_nodes.append(ends)
+        edge_lengths.append(length)
+
+        # Each link holds [neighbor node, edge, start measure, end measure]
+        adjacency.setdefault(ends[0], []).append([ends[1], edge, 0.0, length])
+        adjacency.setdefault(ends[1], []).append([ends[0], edge, length, 0.0])
+
+    return {"edge_nodes": edge_nodes, "edge_lengths": edge_lengths, "adjacency": adjacency}
+
+
+def find_network_path(graph, edge_a, measure_a, edge_b, measure_b, cutoff=float("inf")):
+
+    # Finds the shortest path along the network between a spot on one edge and a spot on another edge.
+    # Returns [path length, pieces], where each piece is [edge, start measure, end measure] in the order travelled.
+    # If there is no path shorter than the cutoff, the length is infinite and there are no pieces.
+    if edge_a == edge_b:
+        length = abs(measure_b - measure_a)
+        if length <= cutoff:
+            return [length, [[edge_a, measure_a, measure_b]]]
+        return [float("inf"), []]
+
+    lengths = graph["edge_lengths"]
+    start_from, start_to = graph["edge_nodes"][edge_a]
+    end_from, end_to = graph["edge_nodes"][edge_b]
+    if start_from < 0 or end_from < 0:
+        return [float("inf"), []]
+
+    # The cost to travel from each node at the end of edge b onto the final spot
+    end_costs = {end_from: measure_b}
+    end_costs[end_to] = min(end_costs.get(end_to, float("inf")), lengths[edge_b] - measure_b)
+
+    # Dijkstra's algorithm, starting from both ends of edge a
+    heap = [(measure_a, 0, start_from, [edge_a, measure_a, 0.0], None),
+            (lengths[edge_a] - measure_a, 1, start_to, [edge_a, measure_a, lengths[edge_a]], None)]
+    heapq.heapify(heap)
+    pushed = 2
+    visited = {}
+    best_length = float("inf")
+    best_node = None
+
+    while heap:
+        cost, _, node, piece, prior = heapq.heappop(heap)
+        if node in visited:
+            continue
+        if cost >= best_length or cost > cutoff:
+            break
+        visited[node] = [prior, piece]
+
+        if node in end_costs and cost + end_costs[node] < best_length:
+            best_length = cost + end_costs[node]
+            best_node = node
+
+        for neighbor, edge, start, end in graph["adjacency"].get(node, []):
+            if neighbor not in visited:
+                heapq.heappush(heap, (cost + lengths[edge], pushed, neighbor, [edge, start, end], node))
+                pushed += 1
+
+    if best_node is None or best_length > cutoff:
+        return [float("inf"), []]
+
+    # Walk back from the end to the start to list every piece of the path
+    if best_node == end_from:
+        pieces = [[edge_b, 0.0, measure_b]]
+    else:
+        pieces = [[edge_b, lengths[edge_b], measure_b]]
+    node = best_node
+    while node is not None:
+        prior, piece = visited[node]
+        pieces.append(piece)
+        node = prior
+    pieces.reverse()
+
+    return [best_length, pieces]
+
+
+def get_file_hash(files):
+
+    # Creates a hash of the contents of one or more files, so we can tell if they changed since they were last used
+    hasher = hashlib.md5()
+    for file_path in files:
+        if not os.path.exists(file_path):
+            hasher.update("Missing".encode("utf-8"))
+            continue
+        with open(file_path, "rb") as f:
+            # DBF files store the date they were last written in bytes 1-3, which should not count as a change
+            if file_path.lower().endswith(".dbf"):
+                hasher.update(f.read(1))
+                f.read(3)
+            for chunk in iter(lambda: f.read(1048576), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_shapefile_hash(shapefile, extensions=[".shp", ".dbf"]):
+    # By default hashes both the geometry (.shp) and the attributes (.dbf) of a shapefile
+    base = os.path.splitext(shapefile)[0]
+    return get_file_hash([base + extension for extension in extensions])
+
+
+def get_data_hash(data):
+    # Creates a hash of any data held in memory
+    return hashlib.md5(repr(data).encode("utf-8")).hexdigest()
+
+
+def read_signature(signature_file):
+    # Reads the signature (a list of hashes and settings) a tool saved the last time it created its outputs
+    if not os.path.exists(signature_file):
+        return None
+    with open(signature_file, "r") as f:
+        return [line.rstrip("\n") for line in f.readlines()]
+
+
+def write_signature(signature_file, signature):
+    with open(signature_file, "w") as f:
+        for line in signature:
+            f.write("{}\n".format(line))
+    return signature_file
+
+
+def get_point_key(label, point_id, x, y):
+    # A point is only the same as a cached point if it has the same ID and has not moved
+    return "{}|{}|{:.6f}|{:.6f}".format(label, point_id, x, y)
+
+
+def read_snap_cache(cache_csv, network_hash):
+
+    # Reads every cached snap that was made to this exact version of the network
+    cache = {}
+    if os.path.exists(cache_csv):
+        for row in csv_to_list(cache_csv)[1:]:
+            if row[1] == network_hash:
+                cache[row[0]] = [float(value) for value in row[2:5]]
+    return cache
+
+
+def write_snap_cache(cache_csv, network_hash, cache):
+    data = [["Key", "Network", "Snap_X", "Snap_Y", "SnapDist"]]
+    for key in sorted(cache):
+        data.append([key, network_hash] + list(cache[key]))
+    return list_to_csv(cache_csv, data)
+
+
+def read_overlay_cache(cache_folder, key):
+
+    # Reads a saved overlay (the overlap length of every field reach and data network segment pair), which can be
+    # reused by any data network with exactly the same line geometry. Returns None if there is none.
+    cache_file = os.path.join(cache_folder, key + ".npz")
+    if not os.path.exists(cache_file):
+        return None
+    cache = np.load(cache_file)
+    return cache["reaches"], cache["segments"], cache["overlap"]
+
+
+def write_overlay_cache(cache_folder, key, overlay):
+    cache_file = os.path.join(cache_folder, key + ".npz")
+    reach_index, segment_index, overlap = overlay
+
+    # Saved under a name of its own first, so that other processes never read a half written file
+    temp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(temp_file, "wb") as f:
+        np.savez(f, reaches=reach_index, segments=segment_index, overlap=overlap)
+    try:
+        os.rename(temp_file, cache_file)
+    except OSError:
+        # Another process saved the same overlay first
+        os.remove(temp_file)
+    return cache_file
+
+
+def lazy_network(network):
+
+    # Returns a function that reads the network the first time it is called, so that it is never read if every
+    # point was already snapped
+    loaded = []
+
+    def get_segments():
+        if not loaded:
+            loaded.append(read_network(network))
+        return loaded[0]
+
+    return get_segments
+
+
+def snap_with_cache(get_segments, cache, keys, x, y):
+
+    # Snaps only the points that are not already in the cache (new points, moved points, or a changed network),
+    # and adds them to the cache. Returns the snapped x and y, the snap distance, and how many points were snapped.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    missing = [count for count, key in enumerate(keys) if key not in cache]
+
+    if missing:
+        new_x, new_y, new_distance, _, _ = snap_to_network(get_segments(), x[missing], y[missing])
+        for count, point in enumerate(missing):
+            cache[keys[point]] = [new_x[count], new_y[count], new_distance[count]]
+
+    snapped = np.array([cache[key] for key in keys], dtype=float).reshape(-1, 3)
+    return snapped[:, 0], snapped[:, 1], snapped[:, 2], len(missing)
+
+
+# The types of reach, by how many of its segments are longer than the length cutoff
+reach_types = ["All", "Multiple", "Single", "None"]
+all_type, multiple_type, single_type, none_type = range(len(reach_types))
+
+# The field reaches this process has read, so a worker only reads each watershed's reaches once. ArcMap keeps this
+# module loaded between runs, so each one is saved with the hash it was read at, and read again if the file changed.
+read_reaches_files = {}
+
+
+def get_extraction_signature_file(reaches_save):
+    return os.path.join(os.path.dirname(reaches_save), "Extraction_Signature.txt")
+
+
+def run_extraction_task(task):
+
+    # Extracts one data network in one watershed, for Step 7. This lives here rather than in the step so that worker
+    # processes can import it, and everything it needs is passed in the task since the step's parameters are not set
+    # in worker processes.
+    _, watershed_folder, data_network_name, data_network, reaches_file, reaches_hash, to_extract, overlay_cache = task
+    arcpy.env.overwriteOutput = True
+    cutoffs = [cutoff for cutoff, _, _ in to_extract]
+    outputs = [reaches_save for _, reaches_save, _ in to_extract]
+
+    # Extracts data from the data network to PIBO reaches using a weighted average system.
+    type_counts = extract_network(get_reaches(reaches_file, reaches_hash), data_network, outputs, cutoffs, overlay_cache)
+
+    # The signature is only saved once the output is finished, so an interrupted extraction is always redone
+    for (_, reaches_save, signature), counts in zip(to_extract, type_counts):
+        create_csv(os.path.join(os.path.dirname(reaches_save), "{}.csv".format(data_network_name)), reaches_save)
+        write_signature(get_extraction_signature_file(reaches_save), signature + counts)
+
+    return watershed_folder, data_network_name, to_extract, type_counts
+
+
+def get_reaches(reaches_file, reaches_hash):
+
+    saved_hash, reaches = read_reaches_files.get(reaches_file, [None, None])
+    if saved_hash != reaches_hash:
+        reaches = read_reaches(reaches_file)
+        read_reaches_files[reaches_file] = [reaches_hash, reaches]
+    return reaches
+
+
+def read_reaches(reaches_file):
+
+    # Reads the field reach lines, and every PNET field (plus where each reach is) as columns
+    fields = get_attribute_fields(reaches_file)
+    with arcpy.da.SearchCursor(reaches_file, ["SHAPE@"]) as cursor:
+        geometries = [row[0] for row in cursor]
+    return {"file": reaches_file, "fields": fields, "geometries": geometries,
+            "columns": read_columns(reaches_file, ["SHAPE@XY"] + fields),
+            "hash": get_shapefile_hash(reaches_file, [".shp"])}
+
+
+def extract_network(reaches, data_network, outputs, cutoffs, overlay_cache):
+
+    # Fields that share a name with a PNET field are left out, as the PNET field is kept.
+    data_fields = [field for field in get_attribute_fields(data_network) if field not in reaches["fields"]]
+
+    # Find how much of each data network segment overlaps each field reach. This only depends on the line geometry of
+    # the reaches and the data network, so an overlay from another run with the same geometry is reused. Overlays saved
+    # before lengths were measured in meters have a different key, so they are never reused.
+    overlay_key = get_data_hash([reaches["hash"], get_shapefile_hash(data_network, [".shp"]), "METERS"])
+    overlay = read_overlay_cache(overlay_cache, overlay_key)
+    if overlay is None:
+        segments = read_columns(data_network, ["SHAPE@"] + data_fields)
+        overlay = overlay_lines(reaches["geometries"], segments.pop(0)["values"])
+        write_overlay_cache(overlay_cache, overlay_key, overlay)
+    else:
+        arcpy.AddMessage("\t\tReusing the overlay of a data network with the same geometry...")
+        segments = read_columns(data_network, data_fields)
+    reach_index, segment_index, overlap = overlay
+
+    # Every overlapping segment becomes a row of its reach, with the reach's fields, the segment's fields, and the
+    # length of the overlap (CLIP_LEN), which is used as the weight for the weighted averages
+    columns = [take_column(column, reach_index) for column in reaches["columns"]] + \
+              [take_column(column, segment_index) for column in segments] + \
+              [{"kind": "number", "values": overlap}]
+    fields = ["SHAPE@XY"] + reaches["fields"] + data_fields + ["CLIP_LEN"]
+
+    add_fields = get_field_definitions(reaches["file"], reaches["fields"]) + \
+        get_field_definitions(data_network, data_fields)
+
+    # The overlaps and attributes are the same for every cutoff, only which segments are used changes
+    type_counts = []
+    for cutoff, output in zip(cutoffs, outputs):
+
+        # This is where all of the math happens. Each PIBO reach now has the necessary data_network data.
+        # Reaches that no data network segment overlaps are left out.
+        if len(reach_index) > 0:
+            condensed, types = combine_segments(columns, fields, cutoff)
+            rows = list(zip(*[decode_column(column) for column in condensed[:-1]]))
+        else:
+            types = np.zeros(0, dtype=int)
+            rows = []
+
+        # Save a point for each reach, only turning codes back into text now
+        write_features(output, "POINT", None, rows, add_fields, "SHAPE@XY", spatial_reference=reaches["file"])
+        type_counts.append(np.bincount(types, minlength=len(reach_types)).tolist())
+
+    return type_counts
+
+
+def combine_segments(columns, fields, cutoff):
+
+    # Condenses the segments of each reach into a single value per column, returning the condensed columns and the
+    # extraction type of each reach. Reaches are returned in the order they first appear.
+    reach_column = columns[fields.index("RchID")]
+    reach_ids = reach_column["codes"] if reach_column["kind"] == "text" else reach_column["values"]
+    lengths = columns[fields.index("CLIP_LEN")]["values"]
+    groups = group_segments(reach_ids)
+
+    # Decide which segments of each reach are used, based on how many are longer than the length cutoff
+    types, keep = categorize_segments(groups, lengths, cutoff)
+
+    # Gather the kept segments so that each reach's segments are next to each other
+    kept = np.flatnonzero(keep)
+    kept = kept[np.argsort(groups[kept], kind="mergesort")]
+    kept_groups = groups[kept]
+    starts = np.flatnonzero(np.concatenate([[True], kept_groups[1:] != kept_groups[:-1]]))
+    kept_lengths = lengths[kept]
+    longest = get_longest_segments(kept_groups, kept_lengths, starts)
+
+    condensed = [None] * len(columns)
+
+    # Text takes the value from the longest segment, as that has the most influence. This is done for every text
+    # column at once, on the codes.
+    text_columns = [count for count, column in enumerate(columns) if column["kind"] == "text"]
+    if text_columns:
+        text_codes = np.column_stack([columns[count]["codes"] for count in text_columns])[kept[longest]]
+        for text_count, count in enumerate(text_columns):
+            condensed[count] = {"kind": "text", "codes": text_codes[:, text_count],
+                                "categories": columns[count]["categories"]}
+
+    # Every number column is condensed at once, as a table with one column per field
+    number_columns = [count for count, column in enumerate(columns) if column["kind"] == "number"]
+    if number_columns:
+        number_values = np.column_stack([columns[count]["values"][kept] for count in number_columns])
+        condensed_values = condense_numbers(number_values, kept_groups, kept_lengths, starts, longest)
+        for number_count, count in enumerate(number_columns):
+            condensed[count] = {"kind": "number", "values": condensed_values[:, number_count]}
+
+    for count, column in enumerate(columns):
+        if column["kind"] == "other":
+            # Anything else takes the value from the first segment
+            condensed[count] = {"kind": "other", "values": [column["values"][kept[start]] for start in starts]}
+
+    return condensed, types
+
+
+def group_segments(reach_ids):
+
+    # Numbers each segment by the reach it belongs to, with reaches numbered in the order they first appear
+    _, first, inverse = np.unique(np.asarray(reach_ids), return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="mergesort")
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)]
+
+
+def categorize_segments(groups, lengths, cutoff):
+
+    # Finds the type of each reach, and which segments are kept for calculations
+    # All: All segments are above the length cutoff, all are kept
+    # Multiple: Multiple, but not all segments are above the cutoff, only those above are kept
+    # Single: A single segment is above the cutoff, only it is kept
+    # None: No segments are above the cutoff, all are kept
+    above = lengths > cutoff
+    num_groups = groups.max() + 1 if len(groups) else 0
+    counts = np.bincount(groups, minlength=num_groups)
+    above_counts = np.bincount(groups, weights=above, minlength=num_groups)
+
+    types = np.select([above_counts == counts, above_counts == 0, above_counts == 1],
+                      [all_type, none_type, single_type], multiple_type)
+    keep = above | (above_counts[groups] == 0)
+    return types, keep
+
+
+def get_longest_segments(groups, lengths, starts):
+
+    # Finds the position of the longest segment of each reach (the first one, if there is a tie)
+    if len(groups) == 0:
+        return np.zeros(0, dtype=int)
+    filled = np.where(np.isnan(lengths), -np.inf, lengths)
+    longest_lengths = np.maximum.reduceat(filled, starts)
+    candidates = np.flatnonzero(filled == longest_lengths[groups])
+    _, first = np.unique(groups[candidates], return_index=True)
+    return candidates[first]
+
+
+def condense_numbers(values, groups, lengths, starts, longest):
+
+    # Condenses a table of numbers (one column per field) into one row per reach
+    # If there is more than one positive value, the length weighted average of the positive values.
+    # Otherwise, the value from the longest segment. If every segment has the same value, that value is used.
+    # The weighted sums come from a sparse reach x segment matrix of overlap lengths, applied to every field at once.
+    # scipy is only imported here, so that steps that never condense segments don't need it.
+    from scipy import sparse
+    num_reaches = len(starts)
+    segment_numbers = np.arange(len(groups))
+    weights = sparse.csr_matrix((lengths, (groups, segment_numbers)), shape=(num_reaches, len(groups)))
+    members = sparse.csr_matrix((np.ones(len(groups)), (groups, segment_numbers)), shape=(num_reaches, len(groups)))
+
+    with np.errstate(invalid="ignore"):
+        positive = values > 0
+    weight_sums = weights.dot(positive.astype(float))
+    value_sums = weights.dot(np.where(positive, values, 0.0))
+    positive_counts = members.dot(positive.astype(float))
+
+    same = np.maximum.reduceat(values, starts) == np.minimum.reduceat(values, starts)
+    weighted = (positive_counts > 1) & (weight_sums > 0) & ~same
+
+    condensed = np.where(same, values[starts], values[longest])
+    condensed[weighted] = value_sums[weighted] / weight_sums[weighted]
+    return condensed
+
+
 def finish():
     print ("\n---Finished!---")
@@ -1,7 +1,7 @@
 import arcpy
 import os
-from PNET_Functions import make_folder, remove_folder, get_folder_list, \
-    finish, attribute_table_to_list, get_field_index, delete_temps
+from PNET_Functions import make_folder, remove_folder, get_folder_list, finish, get_attribute_fields, \
+    write_features, build_polygon_index, partition_features, partition_to_outputs, copy_dataset
 
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 1
@@ -31,66 +31,66 @@ def main():
 
     # Initialize Variables
     arcpy.env.overwriteOutput = True
-    watershed_list = []
+    watershed_folders = []
     to_merge_tor = []
     to_merge_bor = []
-    to_merge_network = []
-    temps_to_delete = []
-    watershed_layer = "Watershed"
-    arcpy.MakeFeatureLayer_management(watersheds, watershed_layer)
+
+    # Read every watershed boundary once
+    watershed_fields = get_attribute_fields(watersheds)
+    name_index = [field.upper() for field in watershed_fields].index("NAME") + 1
+    with arcpy.da.SearchCursor(watersheds, ["SHAPE@"] + watershed_fields) as cursor:
+        watershed_rows = [list(row) for row in cursor]
+
+    # Index the watershed boundaries once for each coordinate system the inputs are in, so every input only needs to
+    # be read a single time. This is done before anything is removed, so inputs that can't be matched stop the tool
+    # while the old project is still there.
+    watershed_shapes = [row[0] for row in watershed_rows]
+    indexes = {}
+    stream_index, tor_index, bor_index = [get_watershed_index(watershed_shapes, in_features, indexes)
+                                          for in_features in [stream_network, tor_points, bor_points]]
 
     # Remove all existing content
     for folder in get_folder_list(root_folder, True):
         remove_folder(folder)
 
-    # Get the name of every watershed
-    # TODO make more general
-    for row in arcpy.da.SearchCursor(watersheds, ["Name"]):
-
-        watershed_list.append(row[0])
-
     # This loops for each watershed
-    for watershed in watershed_list:
+    for row in watershed_rows:
 
-        arcpy.AddMessage("Starting " + watershed + "...")
+        watershed = row[name_index]
+        arcpy.AddMessage("Creating Folders for " + watershed + "...")
 
         # Create folder structure within root folder for this watershed
         watershed_folder = make_structure(root_folder, watershed)
+        watershed_folders.append(watershed_folder)
 
-        # Get the boundary of this watershed
-        query = 'NAME = \'' + watershed + '\''
-        arcpy.SelectLayerByAttribute_management(watershed_layer, 'NEW_SELECTION', query)
-        clipped_watershed = os.path.join(watershed_folder, "Inputs", "Watershed_Boundary", "Watershed_Boundary.shp")
-        arcpy.CopyFeatures_management(watershed_layer, clipped_watershed)
-        arcpy.SelectLayerByAttribute_management(watershed_layer, "CLEAR_SELECTION")
+        # Save the boundary of this watershed
+        boundary_save_location = os.path.join(watershed_folder, "Inputs", "Watershed_Boundary",
+                                              "Watershed_Boundary.shp")
+        write_features(boundary_save_location, "POLYGON", watersheds, [row])
 
-        # Clip the TOR points to this watershed and save them
-        tor_save_location = os.path.join(watershed_folder, "Inputs", "Points", "TOR_Points.shp")
-        tor_temp_location = os.path.join(watershed_folder, "Inputs", "Points", "TOR_Points_Temp.shp")
-        temps_to_delete.append(tor_temp_location)
-        arcpy.Clip_analysis(tor_points, clipped_watershed, tor_temp_location)
+    # Split the stream network between every watershed and save it
+    arcpy.AddMessage("Splitting Stream Network...")
+    stream_save_locations = [os.path.join(watershed_folder, "Inputs", "Stream_Network", "Stream_Network.shp")
+                             for watershed_folder in watershed_folders]
+    partition_to_outputs(stream_network, stream_index, stream_save_locations, "POLYLINE")
 
-        # Only save one point per reach and site
-        year_dif_field = create_year_distance(tor_temp_location, "yr", data_year)
-        delete_identical(tor_temp_location, "SiteID", year_dif_field, "RchID", tor_save_location)
-        to_merge_tor.append(tor_save_location)
+    # This loops once for TOR points, once for BOR points
+    for label, points, to_merge, watershed_index in [["TOR", tor_points, to_merge_tor, tor_index],
+                                                     ["BOR", bor_points, to_merge_bor, bor_index]]:
 
-        # Clip the BOR points to this watershed and save them
-        bor_save_location = os.path.join(watershed_folder, "Inputs", "Points", "BOR_Points.shp")
-        bor_temp_location = os.path.join(watershed_folder, "Inputs", "Points", "BOR_Points_Temp.shp")
-        temps_to_delete.append(bor_temp_location)
-        arcpy.Clip_analysis(bor_points, clipped_watershed, bor_temp_location)
+        arcpy.AddMessage("Splitting {} Points...".format(label))
 
-        # Only save one point per reach and site
-        create_year_distance(bor_temp_location, "yr")
-        delete_identical(bor_temp_location, "SiteID", year_dif_field, "RchID", bor_save_location)
-        to_merge_bor.append(bor_save_location)
+        # Split the points between every watershed
+        point_fields = ["SHAPE@"] + get_attribute_fields(points)
+        watershed_points = [[] for _ in watershed_folders]
+        for number, point_row in partition_features(points, watershed_index, point_fields[1:]):
+            watershed_points[number].append(point_row)
 
-        # Clip the stream_network to this watershed and save it
-        stream_save_location = os.path.join(watershed_folder, "Inputs", "Stream_Network", "Stream_Network.shp")
-        arcpy.Clip_analysis(stream_network, clipped_watershed, stream_save_location)
-        # TODO make more general
-        to_merge_network.append(stream_save_location)
+        # Only save one point per reach and site
+        for watershed_folder, point_rows in zip(watershed_folders, watershed_points):
+            save_location = os.path.join(watershed_folder, "Inputs", "Points", "{}_Points.shp".format(label))
+            delete_identical(point_rows, point_fields, "SiteID", "yr", data_year, "RchID", points, save_location)
+            to_merge.append(save_location)
 
     arcpy.AddMessage("Starting Project Wide...")
 
@@ -111,18 +111,41 @@ def main():
 
     # Take Stream Network, and save it to the ProjectWide folder
     stream_save_location = os.path.join(project_folder, "Inputs", "Stream_Network", "Stream_Network.shp")
-    arcpy.Copy_management(stream_network, stream_save_location)
+    copy_dataset(stream_network, stream_save_location)
 
     arcpy.AddMessage("\t Saving Watersheds...")
     # Take Watershed Boundaries, and save it to the ProjectWide folder
     wat_save_location = os.path.join(project_folder, "Inputs", "Watershed_Boundary", "Watershed_Boundary.shp")
-    arcpy.Copy_management(watersheds, wat_save_location)
-
-    delete_temps(temps_to_delete)
+    copy_dataset(watersheds, wat_save_location)
 
     finish()
 
 
+def get_watershed_index(watershed_shapes, in_features, indexes):
+
+    # Finds the index of the watershed boundaries in the same coordinate system as an input. Clip used to project the
+    # watersheds to match each input, so boundaries in a different coordinate system are projected here too, and the
+    # outputs stay in the input's coordinate system. Each index is only built once.
+    watershed_reference = arcpy.Describe(watersheds).spatialReference
+    spatial_reference = arcpy.Describe(in_features).spatialReference
+    key = spatial_reference.exportToString()
+
+    if key not in indexes:
+        if key == watershed_reference.exportToString():
+            indexes[key] = build_polygon_index(watershed_shapes)
+        elif "Unknown" in [spatial_reference.name, watershed_reference.name]:
+            raise ValueError("The coordinate systems of {} ({}) and the watersheds ({}) don't match, and the "
+                             "watersheds can't be projected to match without both being defined. Define the missing "
+                             "one with Define Projection and run again."
+                             .format(in_features, spatial_reference.name, watershed_reference.name))
+        else:
+            arcpy.AddMessage("Projecting the watersheds from {} to {} to match {}..."
+                             .format(watershed_reference.name, spatial_reference.name, in_features))
+            indexes[key] = build_polygon_index([shape.projectAs(spatial_reference) for shape in watershed_shapes])
+
+    return indexes[key]
+
+
 def make_structure(main_folder, watershed_name):
 
     # Make sure there are no strange characters in the Watershed's name
@@ -166,57 +189,51 @@ def make_structure(main_folder, watershed_name):
     return watershed_folder
 
 
-def create_year_distance(shapefile, year_field, data_year):
-    # Creates a field showing how far away (timewise) the reach is from our target year
-    new_field = "Year_Dif"
-    arcpy.AddField_management(shapefile, new_field, "SHORT")
-    arcpy.CalculateField_management(shapefile, new_field, "abs({} - !{}!)".format(data_year, year_field),"PYTHON_9.3", "")
-    return new_field
+def year_distance(year, data_year):
+    # How far away (timewise) the reach is from our target year
+    if year is None:
+        return None
+    return abs(data_year - int(year))
 
 
-def delete_identical(shapefile, group_field, year_dif_field, id_field, final_save):
+def closest_year_rows(rows, group_index, year_index, id_index, data_year):
 
-    data_list = attribute_table_to_list(shapefile)
-    group_index = get_field_index(group_field, shapefile)
-    year_index = get_field_index(year_dif_field, shapefile)
-    id_index = get_field_index(id_field, shapefile)
+    # Picks the single row per group whose year is closest to the data year, in one pass over the rows.
+    # Ties are broken explicitly so that reruns always keep the same reach:
+    #   1. Smallest year difference
+    #   2. Most recent year
+    #   3. Smallest reach ID
+    best = {}
 
-    # Create a dictionary with entries for each group
-    site_dictionary = {}
+    for position, row in enumerate(rows):
+        year = row[year_index]
+        year_dif = year_distance(year, data_year)
 
-    for row in data_list:
-        if row[group_index] not in site_dictionary:
-            site_dictionary[row[group_index]] = []
-        site_dictionary[row[group_index]].append(row[1:])
+        # Rows without a year are only kept if their site has nothing else
+        if year_dif is None:
+            rank = (1, 0, 0, row[id_index])
+        else:
+            rank = (0, year_dif, -int(year), row[id_index])
 
-    # A list of all reach IDs that need to be kept
-    keep_reaches = []
+        group = row[group_index]
+        if group not in best or rank < best[group][0]:
+            best[group] = (rank, position, row, year_dif)
 
-    # Look at every site
-    for site in site_dictionary:
-        # Create a list of all the different year differences
-        year_difs = []
-        for reach in site_dictionary[site]:
-            year_difs.append(reach[year_index-1])
+    # Returns every kept row in its original order, along with its year difference
+    kept = sorted(best.values(), key=lambda entry: entry[1])
+    return [[row, year_dif] for rank, position, row, year_dif in kept]
 
-        # Find which reach has the smallest year difference in the site
-        minimum = min(year_difs)
-        for reach in site_dictionary[site]:
-            if reach[year_index-1] == minimum:
-                keep_reach = reach[id_index-1]
-        keep_reaches.append(keep_reach)
 
-    # Create a layer to select from
-    select_layer = "Reaches"
-    arcpy.MakeFeatureLayer_management(shapefile, select_layer)
+def delete_identical(rows, fields, group_field, year_field, data_year, id_field, template, final_save):
 
-    # Select all of the reaches we want to keep then invert the selection
-    for good_reach in keep_reaches:
-        arcpy.SelectLayerByAttribute_management(select_layer, 'ADD_TO_SELECTION',
-                                                '{} = {}'.format(id_field, good_reach))
+    # Find the reach closest to the data year for every site
+    keep_rows = closest_year_rows(rows, fields.index(group_field), fields.index(year_field),
+                                  fields.index(id_field), data_year)
 
+    # Write all of the reaches we want to keep at once, along with how far they are from the data year
+    to_write = [list(row) + [year_dif] for row, year_dif in keep_rows]
+    return write_features(final_save, "POINT", template, to_write, [["Year_Dif", "SHORT"]])
 
-    arcpy.CopyFeatures_management(select_layer, final_save)
 
 if __name__ == "__main__":
     main()
@@ -2,7 +2,8 @@ import arcpy
 import os
 import shutil
 from PNET_Functions import get_watershed_folders, delete_old, create_csv, \
-    get_fields, csv_to_list, parse_multistring, make_folder
+    csv_to_list, parse_multistring, make_folder, export_features, load_field_database, get_database_rows, \
+    get_database_numbers, write_features, list_to_csv, parse_bool, get_schema_names
 import scipy.stats as stat
 import numpy as np
 import matplotlib.pyplot as plt
@@ -22,6 +23,13 @@ import math
 root_folder = arcpy.GetParameterAsText(0)
 # CSV to set field data from instead (expects headers)
 input_field_csv = arcpy.GetParameterAsText(1)
+# Whether to also save a shapefile of the comparison points in each metagroup's plot folder
+export_metagroups = parse_bool(arcpy.GetParameterAsText(2))
+
+# Other PNET fields that are saved with the comparison points
+keep_fields = ["POINT_X", "POINT_Y", "SnapDist", "FldRchLen",
+               "EcoRgn_L4", "EcoRgn_L3", "HUC8", "NAME", "StreamName",
+               "PRECIP", "DRAREA", "iGeo_ElMax", "iGeo_ElMin"]
 
 
 def main():
@@ -34,311 +42,185 @@ def main():
     projectwide_database = os.path.join(root_folder, "00_ProjectWide", "Inputs", "Database", "Field_Database.csv")
     delete_old(projectwide_output)
 
-    keep_fields = ["FID", "Shape", "POINT_X", "POINT_Y", "SnapDist", "FldRchLen",
-                   "EcoRgn_L4", "EcoRgn_L3", "HUC8", "NAME", "StreamName",
-                   "PRECIP", "DRAREA", "iGeo_ElMax", "iGeo_ElMin"]
+    #  set the field lists to the values from the file
+    graphs = read_field_csv_new(input_field_csv)
 
+    # The field database Step 9 saved is read once, for every graph and watershed, keeping only the fields graphed
+    store = load_field_database(projectwide_database,
+                                os.path.join(os.path.dirname(projectwide_database), "Field_Database_Cache.pkl"),
+                                [field for graph in graphs for field in graph[4]])
 
+    # The rows of every watershed, for each graph, so the projectwide outputs are made without reading anything again
+    projectwide_rows = [[] for _ in graphs]
+    schemas = [None for _ in graphs]
+    spatial_reference = None
 
-    #  set the field lists to the values from the file
-    # meta_group_field, meta_group_field_name, group_field, group_field_name, field_db_fields = read_field_csv(input_field_csv)
+    for watershed in watershed_folders:
 
-    graphs = read_field_csv_new(input_field_csv)
+        arcpy.AddMessage("Working on {}...".format(watershed))
 
-    for graph in graphs:
+        # Setup watershed data
+        watershed_output = make_folder(os.path.join(watershed, "Outputs", "Comparisons"), "Categorical")
+        delete_old(watershed_output)
 
-        to_merge = []
+        # Get data from the PNET output, and the field data of each PNET reach, once for every graph
+        watershed_pnet = os.path.join(watershed, "Outputs", "Extracted_Data", "All_Data.csv")
+        pnet_data_list = csv_to_list(watershed_pnet)
+        pnet_headers = pnet_data_list.pop(0)
+        rch_ids = [row[pnet_headers.index("""RchID""")] for row in pnet_data_list]
+        db_rows = get_database_rows(store, rch_ids)
 
-        meta_group_field = graph[0]
-        meta_group_field_name = graph[1]
-        group_field = graph[2]
-        group_field_name = graph[3]
-        field_db_fields = graph[4]
+        # Each point is in the same place as the extracted point it came from
+        template = os.path.join(watershed, "Outputs", "Extracted_Data", "Extraction_Merge_Points.shp")
+        with arcpy.da.SearchCursor(template, ["SHAPE@XY"]) as cursor:
+            shapes = [row[0] for row in cursor]
+        spatial_reference = spatial_reference or arcpy.Describe(template).spatialReference
 
-        arcpy.AddMessage("Graphing {}...".format(group_field_name))
+        for graph_num, graph in enumerate(graphs):
 
-        if meta_group_field and group_field_name:
-            meta_exists = True
-        else:
-            meta_exists = False
+            meta_group_field, meta_group_field_name, group_field, group_field_name, field_db_fields = graph
+            arcpy.AddMessage("\tGraphing {}...".format(group_field_name))
 
-        for watershed in watershed_folders:
+            if group_field not in pnet_headers:
+                arcpy.AddMessage("Could not complete plots for {}, could not find {} field".format(watershed, group_field))
+                continue
+            if meta_group_field and group_field_name and meta_group_field not in pnet_headers:
+                arcpy.AddMessage("Could not complete plots for {}, could not find {} field".format(watershed, meta_group_field))
+                continue
 
-            arcpy.AddMessage("\tWorking on {}...".format(watershed))
+            schema, rows = get_graph_rows(graph, pnet_headers, pnet_data_list, rch_ids, store, db_rows, shapes)
+            schemas[graph_num] = schema
+            projectwide_rows[graph_num] += rows
 
-            # Setup watershed data
-            watershed_output = make_folder(os.path.join(watershed, "Outputs", "Comparisons"), "Categorical")
-            delete_old(watershed_output)
+            # Create the shapefile with every field at once, and add in the data
+            comparison_points = write_features(os.path.join(watershed_output, get_graph_file(graph, ".shp")),
+                                               "POINT", None, rows, schema, "SHAPE@XY", spatial_reference=template)
 
-            # Get the CSV with Field data
-            watershed_db = projectwide_database
+            # Save as CSV
+            create_csv(os.path.join(watershed_output, get_graph_file(graph, ".csv")), comparison_points)
 
-            # Get data from the field database
-            field_data_list = csv_to_list(watershed_db)
+            create_graph_plots(comparison_points, schema, rows, graph, watershed_output)
 
-            # Find certain field indexes in the field database
+    # Do projectwide
+    arcpy.AddMessage('Saving ProjectWide...')
+    for graph, schema, rows in zip(graphs, schemas, projectwide_rows):
 
-            id_field_db = field_data_list[0].index("""RchID""")
-            field_indexes_db = []
-            for field_db_field in field_db_fields:
-                field_indexes_db.append(field_data_list[0].index(field_db_field))
+        if schema is None:
+            continue
 
-            # remove headers
-            field_data_list.pop(0)
+        save_loc = write_features(os.path.join(projectwide_output, get_graph_file(graph, ".shp")), "POINT", None,
+                                  rows, schema, "SHAPE@XY", spatial_reference=spatial_reference)
+        create_csv(os.path.join(projectwide_output, get_graph_file(graph, ".csv")), save_loc)
 
-            # Create a list with only necessary data
-            field_compare_list = []
-            for row in field_data_list:
-                to_add = []
-                # Add id column
-                to_add.append(row[id_field_db])
-                # Add any other columns
-                for index in field_indexes_db:
-                    to_add.append(row[index])
-                field_compare_list.append(to_add)
+        create_graph_plots(save_loc, schema, rows, graph, projectwide_output)
 
-            # Get the CSV with extracted PNET data
-            watershed_pnet = os.path.join(watershed, "Outputs", "Extracted_Data", "All_Data.csv")
+        arcpy.Delete_management(save_loc)
 
-            # Get data from the PNET output
-            pnet_data_list = csv_to_list(watershed_pnet)
 
-            # Find certain PNET indexes in the PNET output
-            id_pnet = pnet_data_list[0].index("""RchID""")
-            if group_field not in pnet_data_list[0]:
-                arcpy.AddMessage("Could not complete plots for {}, could not find {} field".format(watershed, group_field))
-            elif meta_exists and meta_group_field not in pnet_data_list[0]:
-                arcpy.AddMessage("Could not complete plots for {}, could not find {} field".format(watershed, meta_group_field))
-            else:
-                group_pnet = pnet_data_list[0].index(group_field)
-                if meta_exists:
-                    meta_group_pnet = pnet_data_list[0].index(meta_group_field)
-
-                # remove headers
-                pnet_data_list.pop(0)
-
-                # Create a list with only necessary data
-                pnet_compare_list = []
-                for row in pnet_data_list:
-                    to_add = []
-                    # Add id column
-                    to_add.append(row[id_pnet])
-                    # Add grouping columns
-                    if meta_exists:
-                        to_add.append(row[meta_group_pnet])
-
-                    to_add.append(row[group_pnet])
-                    # Add this row to the overall list
-                    pnet_compare_list.append(to_add)
-
-                # Make list of new fields
-                if meta_exists:
-                    new_fields = ["""RchID""", meta_group_field_name, group_field_name]
-                else:
-                    new_fields = ["""RchID""", group_field_name]
-
-                for new_field in field_db_fields:
-                    # This is where field data will go
-                    new_fields.append("Y_" + new_field[:8])
-
-                # Perform data comparisons
-
-                both_compare_list = [new_fields]
-
-                for pnet_row in pnet_compare_list:
-                    new_row = []
-                    # Get the ID of the current row
-                    current_site = pnet_row[0]
-                    # Find the corresponding row in the field data list
-                    for db_row_num, db_row in enumerate(field_compare_list):
-                        # If the two site are the same
-                        if db_row[0] == current_site:
-                            field_row = db_row
-                            break
-
-                    # Add the reach ID to our new row
-                    new_row.append(pnet_row[0])
-                    # Add the group/metagroup field to our new row
-                    new_row.append(pnet_row[1])
-                    if meta_exists:
-                        # Add the metagroup to our new row
-                        new_row.append(pnet_row[2])
-
-                    # Prepare to iterate through each column of data, skipping rchID
-                    field_iter = iter(field_row)
-                    next(field_iter)
-
-                    for field_data in field_iter:
-
-                        # Make sure that the data is not missing
-                        if field_data != "":
-
-                            # Add data into the new row
-                            field_num = float(field_data)
-                            new_row.append(field_num)
-
-                        else:
-                            new_row += 0
-
-                    both_compare_list.append(new_row)
-
-                # Add in data for each of the other PNET fields (That were created in previous steps)
-                pnet_data_list = csv_to_list(watershed_pnet)
-                for row_num, row in enumerate(both_compare_list):
-                    # Add data from each PNET field
-                    data_to_add = []
-                    for add_field in keep_fields:
-                        if add_field in pnet_data_list[0]:
-                            this_index = pnet_data_list[0].index(add_field)
-                            data_to_add.append(pnet_data_list[row_num][this_index])
-                    both_compare_list[row_num] = data_to_add + row
-
-
-                # Create a new shapefile to hold data
-                template = os.path.join(watershed, "Outputs", "Extracted_Data", "Extraction_Merge_Points.shp")
-                comparison_points = arcpy.CreateFeatureclass_management(watershed_output, "Categorical_Comparison_Points.shp",
-                                                                        "POINT", spatial_reference=template)
-                to_merge.append(comparison_points)
-
-                # Add in new fields to the shapefile
-                for field, example in zip(both_compare_list[0], both_compare_list[1]):
-                    # Make sure we are not adding in any already existing default fields
-                    shapefile_fields = get_fields(comparison_points)
-                    if field not in shapefile_fields:
-                        # Decide to add a text or float field
-                        if isinstance(example, str):
-                            arcpy.AddField_management(comparison_points, field[:10], "TEXT")
-                        else:
-                            arcpy.AddField_management(comparison_points, field[:10], "FLOAT")
-
-                # Skip headers
-                iter_list = iter(both_compare_list)
-                next(iter_list)
-
-                # remove useless field
-                arcpy.DeleteField_management(comparison_points, "Id")
-
-                # Add in data to the shapefile
-                with arcpy.da.InsertCursor(comparison_points, '*') as inserter:
-                    with arcpy.da.SearchCursor(template, '*') as searcher:
-                        for row, search_row in zip(iter_list, searcher):
-                            # Steal Shape and FID data from template
-                            row[0] = search_row[0]
-                            row[1] = search_row[1]
-                            # Add in row
-                            inserter.insertRow(row)
-
-                # Save as CSV
-                create_csv(os.path.join(watershed_output, "Categorical_Comparison_Data.csv"), comparison_points)
-
-                # Get a list of all the different metagroup types
-                if meta_exists:
-
-                    metagroup_types = unique_values(comparison_points, meta_group_field_name[:10])
-
-                    # Make a folder, shapefile, and plots for every metagroup
-                    if " " in metagroup_types:
-                        metagroup_types.remove(" ")
-
-                    for metagroup in metagroup_types:
-
-                        # Create a new folder for only data in this meta group
-                        plot_folder = make_folder(watershed_output, "{}_{}".format(meta_group_field_name.title(), metagroup.title()))
-                        delete_old(plot_folder)
-
-                        # Create a shapefile with only data we want to look at
-                        layer_name = 'temp'
-                        new_shapefile = os.path.join(plot_folder, '{}_{}_Comparison.shp'.format(meta_group_field_name.title(), metagroup.title()))
-                        arcpy.MakeFeatureLayer_management(comparison_points, layer_name)
-                        query = '{} = \'{}\''.format(meta_group_field_name[:10], metagroup)
-                        arcpy.SelectLayerByAttribute_management(layer_name, 'NEW_SELECTION', query)
-                        arcpy.CopyFeatures_management(layer_name, new_shapefile)
-
-                        # Create plots for this data
-                        create_plots(new_shapefile, group_field_name, field_db_fields, plot_folder, metagroup, meta_group_field_name)
-                else:
-
-                    plot_folder = make_folder(watershed_output, "{}".format(group_field_name.title()))
-                    delete_old(plot_folder)
-
-                    # Create a shapefile with only data we want to look at
-                    layer_name = 'temp'
-                    new_shapefile = os.path.join(plot_folder, '{}_Comparison.shp'.format(group_field_name.title()))
-                    arcpy.MakeFeatureLayer_management(comparison_points, layer_name)
-                    arcpy.CopyFeatures_management(layer_name, new_shapefile)
-
-                    # Create plots for this data
-                    create_plots(new_shapefile, group_field_name, field_db_fields, plot_folder)
-
-                arcpy.Delete_management(new_shapefile)
-
-
-        # Do projectwide
-        arcpy.AddMessage('\tSaving ProjectWide...')
-        save_loc = os.path.join(projectwide_output, "Categorical_Comparison_Points_{}.shp".format(group_field_name))
-        merged = arcpy.Merge_management(to_merge, save_loc)
-        create_csv(os.path.join(projectwide_output, "Categorical_Comparison_Data.csv"), merged)
-
-        if meta_exists:
-
-            # Get a list of all the different metagroup types
-            metagroup_types = unique_values(merged, meta_group_field_name[:10])
-
-            # Make a folder, shapefile, and plots for every metagroup
-            if " " in metagroup_types:
-                metagroup_types.remove(" ")
-
-            for metagroup in metagroup_types:
-                # Create a new folder for only data in this meta group
-                plot_folder = make_folder(projectwide_output, "{}_{}".format(meta_group_field_name.title(), metagroup.title()))
-                delete_old(plot_folder)
-
-                # Create a shapefile with only data we want to look at
-                layer_name = 'temp'
-                new_shapefile = os.path.join(plot_folder,
-                                             '{}_{}_Comparison.shp'.format(meta_group_field_name.title(), metagroup.title()))
-                arcpy.MakeFeatureLayer_management(merged, layer_name)
-                query = '{} = \'{}\''.format(meta_group_field_name[:10], metagroup)
-                arcpy.SelectLayerByAttribute_management(layer_name, 'NEW_SELECTION', query)
-                arcpy.CopyFeatures_management(layer_name, new_shapefile)
-
-                # Create plots for this data
-                create_plots(new_shapefile, group_field_name, field_db_fields, plot_folder, metagroup, meta_group_field_name)
+def get_graph_file(graph, extension):
+    # Each graph is saved separately, named by its group
+    return "Categorical_Comparison_{}_{}{}".format("Points" if extension == ".shp" else "Data", graph[3], extension)
 
-        else:
 
-            plot_folder = make_folder(projectwide_output, "{}".format(group_field_name.title()))
+def get_graph_rows(graph, pnet_headers, pnet_data_list, rch_ids, store, db_rows, shapes):
+
+    # Makes the schema and rows of one graph's comparison points: the other PNET fields, RchID, the groups, and the
+    # field data for each y axis field. Every watershed has the same fields, so they can be saved together.
+    meta_group_field, meta_group_field_name, group_field, group_field_name, field_db_fields = graph
+    if meta_group_field and group_field_name:
+        group_fields, group_names = [meta_group_field, group_field], [meta_group_field_name, group_field_name]
+    else:
+        group_fields, group_names = [group_field], [group_field_name]
+
+    # The PNET fields, RchID and groups are saved as text, and the field data as numbers
+    schema = [[field, "TEXT"] for field in keep_fields + ["""RchID"""] + group_names] + \
+             [["Y_" + field[:8], "FLOAT"] for field in field_db_fields]
+
+    # Other PNET fields that this watershed doesn't have are left empty
+    keep_indexes = [pnet_headers.index(field) if field in pnet_headers else None for field in keep_fields]
+    group_indexes = [pnet_headers.index(field) for field in group_fields]
+
+    # Missing field data is saved as 0
+    field_columns = []
+    for field_db_field in field_db_fields:
+        values = get_database_numbers(store, field_db_field, db_rows)
+        field_columns.append(np.where(np.isnan(values), 0.0, values).tolist())
+
+    rows = []
+    for row_num, (row, rch_id, shape) in enumerate(zip(pnet_data_list, rch_ids, shapes)):
+        rows.append([shape] + [row[index] if index is not None else "" for index in keep_indexes] + [rch_id] +
+                    [row[index] for index in group_indexes] + [column[row_num] for column in field_columns])
+
+    return schema, rows
+
+
+def create_graph_plots(comparison_points, schema, rows, graph, output_folder):
+
+    # Makes the plots of one graph straight from its rows, splitting them by metagroup in memory
+    meta_group_field, meta_group_field_name, group_field, group_field_name, field_db_fields = graph
+    field_names = ["SHAPE@XY"] + [field[0] for field in schema]
+    columns = list(zip(*rows)) if rows else [[] for _ in field_names]
+
+    groups = np.array(columns[field_names.index(group_field_name)])
+    all_values = [np.array(columns[field_names.index("Y_" + field[:8])], dtype=float) for field in field_db_fields]
+
+    # Get a list of all the different metagroup types
+    if meta_group_field and group_field_name:
+
+        metagroups = np.array(columns[field_names.index(meta_group_field_name)])
+        # The name the metagroup field was actually saved under in the comparison points
+        meta_group_key = get_schema_names(field_names[1:], False)[field_names.index(meta_group_field_name) - 1]
+        metagroup_types = sorted(set(metagroups) - {"", " "})
+
+        # Make a folder and plots for every metagroup
+        for metagroup in metagroup_types:
+
+            # Create a new folder for only data in this meta group
+            plot_folder = make_folder(output_folder, "{}_{}".format(meta_group_field_name.title(), metagroup.title()))
             delete_old(plot_folder)
 
-            # Create a shapefile with only data we want to look at
-            layer_name = 'temp'
-            new_shapefile = os.path.join(plot_folder, '{}_Comparison.shp'.format(group_field_name.title()))
-            arcpy.MakeFeatureLayer_management(merged, layer_name)
-            arcpy.CopyFeatures_management(layer_name, new_shapefile)
+            # Create plots for only the data we want to look at
+            in_metagroup = metagroups == metagroup
+            create_plots(groups[in_metagroup], [values[in_metagroup] for values in all_values], group_field_name,
+                         field_db_fields, plot_folder, metagroup, meta_group_field_name)
 
-            # Create plots for this data
-            create_plots(new_shapefile, group_field_name, field_db_fields, plot_folder)
+            # Save a shapefile with only this metagroup's data, if asked to
+            if export_metagroups:
+                new_shapefile = os.path.join(plot_folder, '{}_{}_Comparison.shp'.format(meta_group_field_name.title(), metagroup.title()))
+                export_features(comparison_points, new_shapefile, meta_group_key, [metagroup])
+    else:
 
-        arcpy.Delete_management(new_shapefile)
-        arcpy.Delete_management(merged)
+        plot_folder = make_folder(output_folder, "{}".format(group_field_name.title()))
+        delete_old(plot_folder)
+
+        # Create plots for this data
+        create_plots(groups, all_values, group_field_name, field_db_fields, plot_folder)
+
+        if export_metagroups:
+            new_shapefile = os.path.join(plot_folder, '{}_Comparison.shp'.format(group_field_name.title()))
+            arcpy.CopyFeatures_management(comparison_points, new_shapefile)
 
 
-def create_plots(data_shapefile, group_field, y_axis_fields, out_folder, metagroup = "", metagroup_name = ""):
+def create_plots(groups, all_values, group_field, y_axis_fields, out_folder, metagroup = "", metagroup_name = ""):
 
-    for y_axis_field in y_axis_fields:
+    # The statistics of every box are also saved, so the plots can be made again without reading the data again.
+    # The fliers (values outside the whiskers) of each box are saved in one column, separated by ';'.
+    stats_rows = [["Field", "Group", "N", "Mean", "Whisker_Low", "Q1", "Median", "Q3", "Whisker_High", "Fliers"]]
+
+    for y_axis_field, values in zip(y_axis_fields, all_values):
         try:
-            labels, all_data = get_data(data_shapefile, group_field, y_axis_field)
-            new_labels = []
-            for entry, label in zip(all_data, labels):
-                n = len(entry)
-                new_label = "[{}] ".format(n) + label
-                new_labels.append(new_label)
+            box_stats = get_box_stats(groups, values)
+            for stats in box_stats:
+                stats_rows.append([y_axis_field, stats["group"], stats["n"], stats["mean"], stats["whislo"],
+                                   stats["q1"], stats["med"], stats["q3"], stats["whishi"],
+                                   ";".join(str(flier) for flier in stats["fliers"])])
+
+            # Groups without any data have no box
+            box_stats = [stats for stats in box_stats if stats["n"] > 0]
 
             # set up plot
             fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(9, 9))
-            bplot = ax.boxplot(all_data,
-                               vert=True,  # vertical box alignment
-                               labels=new_labels)  # will be used to label x-ticks
+            bplot = ax.bxp(box_stats, vert=True)
             if metagroup != "":
                 ax.set_title('{} values for all {} groups\n [When {} = {}]'
                               .format(y_axis_field.title(), group_field.title(), metagroup_name.title(), metagroup.title()))
@@ -358,34 +240,67 @@ def create_plots(data_shapefile, group_field, y_axis_fields, out_folder, metagro
         except:
             arcpy.AddMessage("\t\tCould not plot {}".format(y_axis_field))
 
-
-def get_data(data_shapefile, group_field, y_axis_field):
-
-    # Pull comparison values from the comparison points shapefile
-    actual_group_field = group_field[:10]
-    actual_y_axis_field = "Y_" + y_axis_field[:8]
-
-    groups_list = unique_values(data_shapefile, actual_group_field)
-
-    if " " in groups_list:
-        groups_list.remove(" ")
-
-    if "" in groups_list:
-        groups_list.remove("")
-
-    data = []
-
-    for group in groups_list:
-
-        query = '{} = \'{}\''.format(actual_group_field, group)
-        group_data = arcpy.da.FeatureClassToNumPyArray(data_shapefile, actual_y_axis_field, query).astype(np.float)
-
-        # Remove negatives and zeros
-        group_data = group_data[np.where(group_data > 0.0)]
-
-        data.append(group_data)
-
-    return groups_list, data
+    list_to_csv(os.path.join(out_folder, "Box_Plot_Stats.csv"), stats_rows)
+
+
+def get_box_stats(groups, values):
+
+    # Finds the box plot statistics of the positive values in each group, for every group at once. The values are
+    # sorted by group and then by value, so each group's values are next to each other and already in order.
+    group_names, codes = np.unique(groups, return_inverse=True)
+
+    # Remove negatives and zeros, and missing values
+    with np.errstate(invalid="ignore"):
+        valid = values > 0.0
+    codes = codes[valid]
+    values = values[valid]
+    order = np.lexsort((values, codes))
+    codes = codes[order]
+    values = values[order]
+
+    counts = np.bincount(codes, minlength=len(group_names))
+    starts = np.cumsum(counts) - counts
+    has_data = counts > 0
+    last = np.maximum(len(values) - 1, 0)
+
+    def get_quantile(quantile):
+        # Linear interpolation between the two closest values, the same as a box plot
+        position = starts + quantile * np.maximum(counts - 1, 0)
+        lower = np.minimum(np.floor(position).astype(int), last)
+        upper = np.minimum(np.ceil(position).astype(int), last)
+        if len(values) == 0:
+            return np.full(len(group_names), np.nan)
+        result = values[lower] + (values[upper] - values[lower]) * (position - np.floor(position))
+        return np.where(has_data, result, np.nan)
+
+    q1, median, q3 = get_quantile(.25), get_quantile(.5), get_quantile(.75)
+
+    # The whiskers reach the furthest values within 1.5 times the interquartile range of the box
+    low_limit = (q1 - 1.5 * (q3 - q1))[codes]
+    high_limit = (q3 + 1.5 * (q3 - q1))[codes]
+    inside = (values >= low_limit) & (values <= high_limit)
+    whisker_low = np.full(len(group_names), np.nan)
+    whisker_high = np.full(len(group_names), np.nan)
+    if len(values):
+        whisker_low[has_data] = np.minimum.reduceat(np.where(inside, values, np.inf), starts[has_data])
+        whisker_high[has_data] = np.maximum.reduceat(np.where(inside, values, -np.inf), starts[has_data])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.bincount(codes, weights=values, minlength=len(group_names)) / counts
+
+    box_stats = []
+    for count, group_name in enumerate(group_names):
+
+        # Groups with no name are not plotted
+        if group_name in ["", " "]:
+            continue
+
+        group_slice = slice(starts[count], starts[count] + counts[count])
+        box_stats.append({"label": "[{}] {}".format(counts[count], group_name), "group": group_name,
+                          "n": int(counts[count]), "mean": means[count], "whislo": whisker_low[count],
+                          "q1": q1[count], "med": median[count], "q3": q3[count], "whishi": whisker_high[count],
+                          "fliers": values[group_slice][~inside[group_slice]]})
+
+    return box_stats
 
 
 def plot_points(x, y, axis):
@@ -413,29 +328,6 @@ def save_db(database, main_folder):
     return save_loc
 
 
-def read_field_csv(file):
-
-    input_field_list = csv_to_list(file)
-
-    # remove headers
-    input_field_list.pop(0)
-
-    meta = input_field_list[0][0]
-    meta_name = input_field_list[0][1]
-    group = input_field_list[0][2]
-    group_name = input_field_list[0][3]
-    fields = [input_field_list[0][4]]
-
-    # remove top row
-    input_field_list.pop(0)
-
-    for y_axis_field in input_field_list:
-        fields.append(y_axis_field[4])
-
-    return meta, meta_name, group, group_name, fields
-
-
-
 def read_field_csv_new(file):
     input_field_list = csv_to_list(file)
 
@@ -473,12 +365,5 @@ def is_csv(file):
     return file.endswith('.csv')
 
 
-def unique_values(table, field):
-
-    # Adapted from https://gis.stackexchange.com/questions/208430/trying-to-extract-a-list-of-unique-values-from-a-field-using-python
-    with arcpy.da.SearchCursor(table, [field]) as cursor:
-        return sorted({row[0] for row in cursor})
-
-
 if __name__ == "__main__":
     main()
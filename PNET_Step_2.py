@@ -1,6 +1,10 @@
 import arcpy
 import os
-from PNET_Functions import is_even, get_watershed_folders, delete_old, finish, parse_bool
+import numpy as np
+from PNET_Functions import get_watershed_folders, delete_old, finish, parse_bool, parse_multistring, make_folder, \
+    remove_folder, get_attribute_fields, write_features, list_to_csv, csv_to_list, get_shapefile_hash, \
+    read_signature, write_signature, get_point_key, read_snap_cache, write_snap_cache, lazy_network, snap_with_cache, \
+    snap_candidates, build_network_graph, find_network_path, copy_dataset
 
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 2
@@ -15,26 +19,44 @@ from PNET_Functions import is_even, get_watershed_folders, delete_old, finish, p
 root_folder = arcpy.GetParameterAsText(0)
 # Set this to true if you want the threshold value to be used. This should almost always be True
 use_threshold = parse_bool(arcpy.GetParameterAsText(1))
-# The longest distance (m) to go before snapping stops and remaining points are considered outliers to be investigated
-threshold_range = int(arcpy.GetParameterAsText(2))
-# Snapping distances will increase by this increment (m). Default is ten. Lower values mean longer run time.
-custom_increment = 10
+# The longest distance (m) to go before snapping stops and remaining points are considered outliers to be investigated.
+# Multiple thresholds can be given (separated by ';'). The first is used going forward, the rest are saved for review.
+threshold_list = [int(threshold) for threshold in parse_multistring(arcpy.GetParameterAsText(2)) if threshold]
+# Set this to true to snap the TOR and BOR points of each site together, keeping them connected along the network
+pair_snapping = parse_bool(arcpy.GetParameterAsText(3))
+# The snap distance given to points that could not be snapped
+unsnapped_value = 999
+# How many of the closest edges are considered for each point when snapping pairs
+pair_candidates = 5
+# How many times longer than the straight line distance between a site's points the path between them can be
+max_path_ratio = 3
 
 
 def main():
 
     # Initialize Variables
     arcpy.env.overwriteOutput = True
-    saved_tor_points_snapped = []
-    saved_bor_points_snapped = []
-    saved_tor_points_unsnapped = []
-    saved_bor_points_unsnapped = []
-
     watershed_folders = get_watershed_folders(root_folder)
+    projectwide_folder = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Points")
+
+    # Without a threshold every point is snapped, no matter the distance
+    if use_threshold:
+        thresholds = [threshold for count, threshold in enumerate(threshold_list)
+                      if threshold not in threshold_list[:count]]
+    else:
+        thresholds = [None]
+
+    # Holds every saved shapefile to merge, keyed by where it is saved relative to the points folder
+    to_merge = {}
+    summary_headers = ["Watershed", "Threshold", "TOR_Snapped", "TOR_Unsnapped", "BOR_Snapped", "BOR_Unsnapped"]
+    projectwide_summary = [summary_headers]
+    unresolved_headers = ["Watershed", "SiteID", "TOR_RchID", "BOR_RchID", "Reason"]
+    projectwide_unresolved = [unresolved_headers]
 
     # Delete old content from this tool being re run.
-    delete_old(os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Points", "Snapped"))
-    delete_old(os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Points", "Unsnapped"))
+    delete_old(os.path.join(projectwide_folder, "Snapped"))
+    delete_old(os.path.join(projectwide_folder, "Unsnapped"))
+    remove_folder(os.path.join(projectwide_folder, "Thresholds"))
 
     # This loops for every watershed
     for watershed_folder in watershed_folders:
@@ -44,130 +66,281 @@ def main():
         # Get all file names
         output_folder = os.path.join(watershed_folder, "Intermediates", "Points")
         network = os.path.join(watershed_folder, "Inputs", "Stream_Network", "Stream_Network.shp")
+        summary_csv = os.path.join(output_folder, "Threshold_Summary.csv")
+        cache_csv = os.path.join(output_folder, "Snap_Cache.csv")
+        signature_file = os.path.join(output_folder, "Snap_Signature.txt")
+        unresolved_csv = os.path.join(output_folder, "Unresolved_Sites.csv")
+        points_list = [[label, os.path.join(watershed_folder, "Inputs", "Points", "{}_Points.shp".format(label))]
+                       for label in ["TOR", "BOR"]]
+
+        # Every shapefile this watershed saves, as [[save folder, snap type, label], file location]
+        saves = get_save_locations(output_folder, thresholds)
+        for merge_key, save in saves:
+            to_merge.setdefault(merge_key, []).append(save)
+
+        # Skip this watershed if its points, network, and thresholds are the same as the last time it was run
+        network_hash = get_shapefile_hash(network, [".shp"])
+        signature = [network_hash] + [get_shapefile_hash(points) for _, points in points_list] + \
+                    [str(use_threshold), ";".join([get_threshold_name(threshold) for threshold in thresholds]),
+                     str(pair_snapping)]
+        if read_signature(signature_file) == signature and os.path.exists(summary_csv) and \
+                all([arcpy.Exists(save) for _, save in saves]) and \
+                (os.path.exists(unresolved_csv) or not pair_snapping):
+            arcpy.AddMessage("\t Nothing has changed, keeping previous outputs")
+            projectwide_summary += csv_to_list(summary_csv)[1:]
+            if pair_snapping:
+                projectwide_unresolved += csv_to_list(unresolved_csv)[1:]
+            continue
 
         delete_old(os.path.join(output_folder, "Snapped"))
         delete_old(os.path.join(output_folder, "Unsnapped"))
+        remove_folder(os.path.join(output_folder, "Thresholds"))
+        if os.path.exists(unresolved_csv):
+            os.remove(unresolved_csv)
 
-        bor_points_old = os.path.join(watershed_folder, "Inputs", "Points", "BOR_Points.shp")
-        tor_points_old = os.path.join(watershed_folder, "Inputs", "Points", "TOR_Points.shp")
+        # Only points that are new, have moved, or are on a changed network need to be snapped
+        cache = read_snap_cache(cache_csv, network_hash)
+        current_cache = {}
 
-        bor_points_new_temp = os.path.join(output_folder, "BOR_Points_Temp.shp")
-        tor_points_new_temp = os.path.join(output_folder, "TOR_Points_Temp.shp")
+        # The network is only read if there is something to snap, and then used for both TOR and BOR points
+        get_segments = lazy_network(network)
+        counts = [[] for _ in thresholds]
 
-        bor_points_new_snapped = os.path.join(output_folder, "Snapped", "BOR_Points_Snapped.shp")
-        tor_points_new_snapped = os.path.join(output_folder, "Snapped", "TOR_Points_Snapped.shp")
-        saved_bor_points_snapped.append(bor_points_new_snapped)
-        saved_tor_points_snapped.append(tor_points_new_snapped)
+        # This loops once for TOR and once for BOR, snaps all points
+        all_snapped = []
+        for label, points in points_list:
+
+            # Every snap distance is only calculated once, each threshold is then just a filter
+            snapped_points = snap_points(points, label, get_segments, cache)
+            arcpy.AddMessage("\t Snapped {} new {} Points...".format(snapped_points["num_new"], label))
+            for key in snapped_points["keys"]:
+                current_cache[key] = cache[key]
+            all_snapped.append(snapped_points)
+
+        # Move the points of each site so that the TOR and BOR land on connected parts of the network
+        if pair_snapping:
+            arcpy.AddMessage("\t Snapping TOR and BOR Pairs...")
+            unresolved = snap_pairs(all_snapped[0], all_snapped[1], get_segments(), thresholds[0])
+            watershed_unresolved = [unresolved_headers] + [[os.path.basename(watershed_folder)] + row
+                                                           for row in unresolved]
+            list_to_csv(unresolved_csv, watershed_unresolved)
+            projectwide_unresolved += watershed_unresolved[1:]
+            arcpy.AddMessage("\t {} Sites could not be resolved".format(len(unresolved)))
+
+        for (label, points), snapped_points in zip(points_list, all_snapped):
+            for threshold_count, threshold in enumerate(thresholds):
+                for save_folder in get_save_folders(thresholds, threshold):
+
+                    snapped_save = get_save_location(output_folder, save_folder, "Snapped", label)
+                    unsnapped_save = get_save_location(output_folder, save_folder, "Unsnapped", label)
+                    make_threshold_folders(output_folder, save_folder)
+
+                    num_snapped, num_unsnapped = save_threshold(points, snapped_points, threshold,
+                                                                snapped_save, unsnapped_save)
+
+                counts[threshold_count] += [num_snapped, num_unsnapped]
+
+        # Save a table of how many points each threshold keeps
+        watershed_summary = [summary_headers]
+        for threshold, threshold_counts in zip(thresholds, counts):
+            watershed_summary.append([os.path.basename(watershed_folder), get_threshold_name(threshold)]
+                                     + threshold_counts)
+        list_to_csv(summary_csv, watershed_summary)
+        projectwide_summary += watershed_summary[1:]
+
+        # Only keep points that still exist in the cache, and remember what this watershed was run with
+        write_snap_cache(cache_csv, network_hash, current_cache)
+        write_signature(signature_file, signature)
 
-        bor_points_new_unsnapped = os.path.join(output_folder, "Unsnapped", "BOR_Points_Unsnapped.shp")
-        tor_points_new_unsnapped = os.path.join(output_folder, "Unsnapped", "TOR_Points_Unsnapped.shp")
-        saved_bor_points_unsnapped.append(bor_points_new_unsnapped)
-        saved_tor_points_unsnapped.append(tor_points_new_unsnapped)
+    arcpy.AddMessage("Saving ProjectWide Files...")
 
-        arcpy.CopyFeatures_management(bor_points_old, bor_points_new_temp)
-        arcpy.CopyFeatures_management(tor_points_old, tor_points_new_temp)
+    for (save_folder, snap_type, label), to_merge_points in sorted(to_merge.items()):
 
-        points_list = [tor_points_new_temp, bor_points_new_temp]
+        make_threshold_folders(projectwide_folder, save_folder)
+        merged = get_save_location(projectwide_folder, save_folder, snap_type, label)
+        arcpy.Merge_management(to_merge_points, merged)
 
-        # This loops once for TOR and once for BOR, snaps all points
-        for counter, points in enumerate(points_list):
-            if counter == 0:
-                label = "TOR"
-            else:
-                label = "BOR"
-            snap_dist = 0
-            all_snapped = False
-            total_points = arcpy.GetCount_management(points)
-            base_list = []
-
-            # TODO make more general
-            for row in arcpy.da.SearchCursor(points, "RchID"):
-                base_list.append(row[0])
-            snap_value_list = [999] * len(base_list)
-            arcpy.AddField_management(points, "SnapDist", "SHORT")
-
-            # This loops until all points are snapped to the network, incrementing the snap distance by 10 each time.
-            while all_snapped is False:
-
-                # Increment snap distance by an increment
-                snap_dist += custom_increment
-                snap_name = str(snap_dist) + " Meters"
-                arcpy.AddMessage("\t Snapping {} {}".format(label, snap_name))
-
-                # Snap the points
-                arcpy.Snap_edit(points, [[network, "EDGE", snap_name]])
-                temp = os.path.join(watershed_folder, "temporary.shp")
-
-                # Create an intersect of the points and the network
-                arcpy.Intersect_analysis([points, network], temp)
-                current_snapped = arcpy.GetCount_management(temp)
-
-                # Update each snap distance value for points that were just snapped
-                # TODO make more general
-                for row in arcpy.da.SearchCursor(temp, "RchID"):
-                    if snap_value_list[base_list.index(row[0])] == 999:
-                        snap_value_list[base_list.index(row[0])] = snap_dist
-
-                # Checks to see if every point has been snapped yet
-                if (str(current_snapped) == str(total_points)) or \
-                        (use_threshold is True and snap_dist >= threshold_range):
-
-                    # All points have been snapped, or are beyond the given threshold
-                    all_snapped = True
-
-                    # Delete temporary file
-                    arcpy.Delete_management(temp)
-
-            # Add XY data to each point
-            arcpy.AddXY_management(points)
-
-            # Populate the snap distance field
-            with arcpy.da.UpdateCursor(points, "SnapDist") as cursor:
-                for count, row in enumerate(cursor):
-                    row[0] = snap_value_list[count]
-                    cursor.updateRow(row)
-
-            # Create a layer to select from
-            points_layer = "Points"
-            arcpy.MakeFeatureLayer_management(points, points_layer)
-
-            # Save snapped and unsnapped points
-            if label == "TOR":
-                arcpy.SelectLayerByAttribute_management(points_layer, 'NEW_SELECTION', 'SnapDist >= 999')
-                arcpy.CopyFeatures_management(points_layer, tor_points_new_unsnapped)
-                arcpy.SelectLayerByAttribute_management(points_layer, 'SWITCH_SELECTION')
-                arcpy.CopyFeatures_management(points_layer, tor_points_new_snapped)
-                arcpy.SelectLayerByAttribute_management(points_layer, 'CLEAR_SELECTION')
-
-            if label == "BOR":
-                arcpy.SelectLayerByAttribute_management(points_layer, 'NEW_SELECTION', 'SnapDist >= 999')
-                arcpy.CopyFeatures_management(points_layer, bor_points_new_unsnapped)
-                arcpy.SelectLayerByAttribute_management(points_layer, 'SWITCH_SELECTION')
-                arcpy.CopyFeatures_management(points_layer, bor_points_new_snapped)
-                arcpy.SelectLayerByAttribute_management(points_layer, 'CLEAR_SELECTION')
-
-        # Delete temporary files
-        arcpy.Delete_management(bor_points_new_temp)
-        arcpy.Delete_management(tor_points_new_temp)
+        # Unsnapped points are duplicated so that they can be fixed by hand, without changing the original
+        if snap_type == "Unsnapped":
+            copy_dataset(merged, os.path.join(projectwide_folder, save_folder, "Unsnapped_Fixed",
+                                              "To_Fix_{}.shp".format(label)))
 
-    arcpy.AddMessage("Saving ProjectWide Files...")
+    list_to_csv(os.path.join(projectwide_folder, "Threshold_Summary.csv"), projectwide_summary)
+    if pair_snapping:
+        list_to_csv(os.path.join(projectwide_folder, "Unresolved_Sites.csv"), projectwide_unresolved)
 
-    output_folder = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Points")
+    finish()
 
-    bor_points_new_snapped = os.path.join(output_folder, "Snapped", "BOR_Points_Snapped.shp")
-    tor_points_new_snapped = os.path.join(output_folder, "Snapped", "TOR_Points_Snapped.shp")
-    bor_points_new_unsnapped = os.path.join(output_folder, "Unsnapped", "BOR_Points_Unsnapped.shp")
-    tor_points_new_unsnapped = os.path.join(output_folder, "Unsnapped", "TOR_Points_Unsnapped.shp")
 
-    arcpy.Merge_management(saved_bor_points_snapped, bor_points_new_snapped)
-    arcpy.Merge_management(saved_tor_points_snapped, tor_points_new_snapped)
-    arcpy.Merge_management(saved_bor_points_unsnapped, bor_points_new_unsnapped)
-    arcpy.Merge_management(saved_tor_points_unsnapped, tor_points_new_unsnapped)
+def get_threshold_name(threshold):
+    if threshold is None:
+        return "None"
+    return "{}m".format(threshold)
 
-    arcpy.Copy_management(bor_points_new_unsnapped, os.path.join(output_folder, "Unsnapped_Fixed", "To_Fix_BOR.shp"))
-    arcpy.Copy_management(tor_points_new_unsnapped, os.path.join(output_folder, "Unsnapped_Fixed", "To_Fix_TOR.shp"))
 
-    finish()
+def get_save_folders(thresholds, threshold):
+
+    # The first threshold is saved into the normal folders, to be used by the rest of PNET.
+    # When there are multiple thresholds, every threshold also gets its own folder for comparison.
+    save_folders = []
+    if threshold == thresholds[0]:
+        save_folders.append("")
+    if len(thresholds) > 1:
+        save_folders.append(os.path.join("Thresholds", get_threshold_name(threshold)))
+    return save_folders
+
+
+def get_save_location(points_folder, save_folder, snap_type, label):
+    return os.path.join(points_folder, save_folder, snap_type, "{}_Points_{}.shp".format(label, snap_type))
+
+
+def get_save_locations(points_folder, thresholds):
+
+    # Lists every shapefile that will be saved for a watershed, along with where it will be merged project wide
+    saves = []
+    for label in ["TOR", "BOR"]:
+        for threshold in thresholds:
+            for save_folder in get_save_folders(thresholds, threshold):
+                for snap_type in ["Snapped", "Unsnapped"]:
+                    saves.append([(save_folder, snap_type, label),
+                                  get_save_location(points_folder, save_folder, snap_type, label)])
+    return saves
+
+
+def make_threshold_folders(points_folder, save_folder):
+
+    # Makes sure the Snapped, Unsnapped, and Unsnapped_Fixed folders exist
+    if save_folder:
+        threshold_folder = make_folder(make_folder(points_folder, "Thresholds"), os.path.basename(save_folder))
+    else:
+        threshold_folder = points_folder
+    for folder in ["Snapped", "Unsnapped", "Unsnapped_Fixed"]:
+        make_folder(threshold_folder, folder)
+    return threshold_folder
+
+
+def snap_points(points, label, get_segments, cache):
+
+    # Read every point into memory
+    fields = get_attribute_fields(points)
+    with arcpy.da.SearchCursor(points, ["SHAPE@XY"] + fields) as cursor:
+        rows = [list(row) for row in cursor]
+    xy = np.array([row[0] for row in rows], dtype=float).reshape(-1, 2)
+
+    # Find the exact closest spot on the network for every point that is not already cached
+    id_index = fields.index("RchID") + 1
+    site_index = fields.index("SiteID") + 1
+    keys = [get_point_key(label, row[id_index], row[0][0], row[0][1]) for row in rows]
+    snap_x, snap_y, snap_dist, num_new = snap_with_cache(get_segments, cache, keys, xy[:, 0], xy[:, 1])
+
+    # Add XY and snap distance fields, unless the points already have them
+    new_fields = [["POINT_X", "DOUBLE"], ["POINT_Y", "DOUBLE"], ["SnapDist", "DOUBLE"]]
+    add_fields = [new_field for new_field in new_fields if new_field[0] not in fields]
+    out_fields = fields + [new_field[0] for new_field in add_fields]
+
+    # Create a version of every point for if it is snapped, and for if it is left where it is
+    snapped_rows = []
+    unsnapped_rows = []
+
+    for count, row in enumerate(rows):
+        for shape, distance, to_add in [[(snap_x[count], snap_y[count]), float(snap_dist[count]), snapped_rows],
+                                        [row[0], unsnapped_value, unsnapped_rows]]:
+            values = dict(zip(fields, row[1:]))
+            values["POINT_X"] = shape[0]
+            values["POINT_Y"] = shape[1]
+            values["SnapDist"] = distance
+            to_add.append([shape] + [values[field] for field in out_fields])
+
+    return {"add_fields": add_fields, "out_fields": out_fields, "snapped": snapped_rows, "unsnapped": unsnapped_rows,
+            "distance": snap_dist, "keys": keys, "num_new": num_new, "xy": xy,
+            "site_ids": [row[site_index] for row in rows], "ids": [row[id_index] for row in rows]}
+
+
+def move_snapped_point(snapped_points, count, x, y, distance):
+
+    # Changes where a point is snapped to, along with its XY and snap distance fields
+    row = snapped_points["snapped"][count]
+    out_fields = snapped_points["out_fields"]
+    row[0] = (x, y)
+    row[out_fields.index("POINT_X") + 1] = x
+    row[out_fields.index("POINT_Y") + 1] = y
+    row[out_fields.index("SnapDist") + 1] = distance
+    snapped_points["distance"][count] = distance
+
+
+def snap_pairs(tor_points, bor_points, network_segments, threshold):
+
+    # For every site, looks at the closest edges to both its TOR and BOR points, and picks the pair of spots that are
+    # connected along the network with the smallest total snap distance. Returns a list of sites that were not resolved,
+    # as [SiteID, TOR RchID, BOR RchID, Reason]. Points of unresolved sites keep their normal snap.
+    graph = build_network_graph(network_segments)
+    max_distance = float("inf") if threshold is None else threshold
+    unresolved = []
+
+    sites = {}
+    for snap_type, snapped_points in enumerate([tor_points, bor_points]):
+        for count, site_id in enumerate(snapped_points["site_ids"]):
+            sites.setdefault(site_id, [[], []])[snap_type].append(count)
+
+    for site_id, (tor_counts, bor_counts) in sorted(sites.items()):
+
+        tor_ids = ";".join([str(tor_points["ids"][count]) for count in tor_counts])
+        bor_ids = ";".join([str(bor_points["ids"][count]) for count in bor_counts])
+
+        if len(tor_counts) != 1 or len(bor_counts) != 1:
+            unresolved.append([site_id, tor_ids, bor_ids, "Site does not have exactly one TOR and one BOR point"])
+            continue
+
+        tor_x, tor_y = tor_points["xy"][tor_counts[0]]
+        bor_x, bor_y = bor_points["xy"][bor_counts[0]]
+        tor_candidates = snap_candidates(network_segments, tor_x, tor_y, max_distance, pair_candidates)
+        bor_candidates = snap_candidates(network_segments, bor_x, bor_y, max_distance, pair_candidates)
+
+        if not tor_candidates or not bor_candidates:
+            unresolved.append([site_id, tor_ids, bor_ids, "No part of the network is within the threshold"])
+            continue
+
+        # The path between the points cannot be much longer than the furthest the snapped points could be apart
+        cutoff = max_path_ratio * (np.hypot(tor_x - bor_x, tor_y - bor_y) + tor_candidates[-1][4] +
+                                   bor_candidates[-1][4])
+
+        best = None
+        for tor_edge, tor_measure, tor_snap_x, tor_snap_y, tor_distance in tor_candidates:
+            for bor_edge, bor_measure, bor_snap_x, bor_snap_y, bor_distance in bor_candidates:
+                path_length = find_network_path(graph, tor_edge, tor_measure, bor_edge, bor_measure, cutoff)[0]
+                if path_length <= cutoff:
+                    score = (tor_distance + bor_distance, path_length)
+                    if best is None or score < best[0]:
+                        best = [score, [tor_snap_x, tor_snap_y, tor_distance], [bor_snap_x, bor_snap_y, bor_distance]]
+
+        if best is None:
+            unresolved.append([site_id, tor_ids, bor_ids, "TOR and BOR are not connected along the network"])
+            continue
+
+        move_snapped_point(tor_points, tor_counts[0], *best[1])
+        move_snapped_point(bor_points, bor_counts[0], *best[2])
+
+    return unresolved
+
+
+def save_threshold(points, snapped_points, threshold, snapped_save, unsnapped_save):
+
+    # Points beyond the threshold (or with nowhere to snap to) are left where they are
+    snap_dist = snapped_points["distance"]
+    if threshold is None:
+        is_snapped = np.isfinite(snap_dist)
+    else:
+        is_snapped = snap_dist <= threshold
+
+    snapped_rows = [row for row, keep in zip(snapped_points["snapped"], is_snapped) if keep]
+    unsnapped_rows = [row for row, keep in zip(snapped_points["unsnapped"], is_snapped) if not keep]
+
+    # Save snapped and unsnapped points
+    add_fields = snapped_points["add_fields"]
+    write_features(snapped_save, "POINT", points, snapped_rows, add_fields, "SHAPE@XY")
+    write_features(unsnapped_save, "POINT", points, unsnapped_rows, add_fields, "SHAPE@XY")
+
+    return len(snapped_rows), len(unsnapped_rows)
 
 
 if __name__ == "__main__":
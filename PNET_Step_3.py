@@ -1,6 +1,11 @@
 import arcpy
 import os
-from PNET_Functions import get_watershed_folders, delete_old, finish, delete_temps, is_empty, parse_bool
+import numpy as np
+from PNET_Functions import get_watershed_folders, delete_old, finish, is_empty, parse_bool, \
+    get_attribute_fields, write_features, build_polygon_index, partition_features, get_shapefile_hash, \
+    get_data_hash, read_signature, write_signature, get_point_key, read_snap_cache, write_snap_cache, \
+    lazy_network, snap_with_cache, read_network, snap_to_network, build_network_graph, find_network_path, \
+    get_path_vertices, get_field_type, list_to_csv, copy_dataset, read_watershed_boundaries, split_network_at_junctions
 
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 3
@@ -17,6 +22,10 @@ root_folder = arcpy.GetParameterAsText(0)
 # If True, this indicates that the user edited the unsnapped points, and the corrections are now saved in
 # ProjectWide/Intermediates/Points/Unsnapped_Fixed
 fixed_points = parse_bool(arcpy.GetParameterAsText(1))
+# Fixed points within this distance (m) of the network are snapped to it, in case editing wasn't perfect
+fixed_snap_distance = 10
+# Points further than this distance (m) from the network are not used to build field reaches
+reach_point_distance = 10
 
 
 def main():
@@ -30,12 +39,10 @@ def main():
 
     project_networks = []
     project_points = []
-    temps_to_delete = []
 
     if fixed_points:
-        network = os.path.join(root_folder, "00_ProjectWide", "Inputs", "Stream_Network", "Stream_Network.shp")
         fixed_folder = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Points", "Unsnapped_Fixed")
-        save_fixed_points(network, fixed_folder, watershed_folders)
+        save_fixed_points(fixed_folder, watershed_folders)
 
     # For each watershed:
     for watershed_folder in watershed_folders:
@@ -45,98 +52,135 @@ def main():
         # Get all file names
         output_folder = os.path.join(watershed_folder, "Intermediates", "Reach_Editing", "Inputs")
         network = os.path.join(watershed_folder, "Inputs", "Stream_Network", "Stream_Network.shp")
+        points_folder = os.path.join(watershed_folder, "Intermediates", "Points")
+        merge_location = os.path.join(output_folder, "Points_Merge.shp")
+        save_location = os.path.join(output_folder, "Stream_Network_Segments.shp")
+        project_points.append(merge_location)
+        project_networks.append(save_location)
+
+        # Skip this watershed if its network, snapped points, and fixed points are the same as last time
+        signature_file = os.path.join(watershed_folder, "Intermediates", "Reach_Editing", "Editing_Signature.txt")
+        signature = [get_shapefile_hash(network, [".shp"]), str(fixed_points)]
+        for label in ["TOR", "BOR"]:
+            signature.append(get_shapefile_hash(os.path.join(points_folder, "Snapped",
+                                                             "{}_Points_Snapped.shp".format(label))))
+            if fixed_points:
+                signature.append(get_shapefile_hash(os.path.join(points_folder, "Unsnapped_Fixed",
+                                                                 "{}_Points_Fixed.shp".format(label))))
+        if read_signature(signature_file) == signature and \
+                arcpy.Exists(merge_location) and arcpy.Exists(save_location):
+            arcpy.AddMessage("\t Nothing has changed, keeping previous outputs")
+            save_to_edit(watershed_folder, merge_location, save_location)
+            continue
 
         delete_old(output_folder)
 
-        new_tor_filename = "temp_tor.shp"
-        new_tor_points = os.path.join(watershed_folder, new_tor_filename)
-        temps_to_delete.append(new_tor_points)
-
-        new_bor_filename = "temp_bor.shp"
-        new_bor_points = os.path.join(watershed_folder, new_bor_filename)
-        temps_to_delete.append(new_bor_points)
-
-        old_tor_points = os.path.join(watershed_folder, "Intermediates", "Points", "Snapped", "TOR_Points_Snapped.shp")
-        old_bor_points = os.path.join(watershed_folder, "Intermediates", "Points", "Snapped", "BOR_Points_Snapped.shp")
-
-        if fixed_points:
-            # Merge the now fixed points with the snapped points, and use this going forward
-            tor_temp_name = "temp_tor_merge.shp"
-            tor_temp_merge = os.path.join(watershed_folder, tor_temp_name)
-            tor_fixed = \
-                os.path.join(watershed_folder, "Intermediates", "Points", "Unsnapped_Fixed", "TOR_Points_Fixed.shp")
-            if not is_empty(tor_fixed):
-                arcpy.Merge_management([tor_fixed, old_tor_points], tor_temp_merge)
-                temps_to_delete.append(tor_temp_merge)
-                old_tor_points = tor_temp_merge
-
-            bor_temp_name = "temp_bor_merge.shp"
-            bor_temp_merge = os.path.join(watershed_folder, bor_temp_name)
-            bor_fixed = \
-                os.path.join(watershed_folder, "Intermediates", "Points", "Unsnapped_Fixed", "BOR_Points_Fixed.shp")
-            if not is_empty(bor_fixed):
-                arcpy.Merge_management([bor_fixed, old_bor_points], bor_temp_merge)
-                temps_to_delete.append(bor_temp_merge)
-                old_bor_points = bor_temp_merge
-
-        arcpy.CopyFeatures_management(old_tor_points, new_tor_points)
-        arcpy.CopyFeatures_management(old_bor_points, new_bor_points)
-
-        points_list = [new_tor_points, new_bor_points]
-        tor_bor_list = ("\"TOR\"", "\"BOR\"")
-
-        # This loops once for TOR points, once for BOR points
-        for points, tor_bor in zip(points_list, tor_bor_list):
-
-            # Add and populate TOR_BOR Field
-            arcpy.AddField_management(points, "TOR_BOR", "TEXT")
-            arcpy.CalculateField_management(points, "TOR_BOR", tor_bor)
-
-        # Merge TOR_BOR Points
-        merge_location = os.path.join(watershed_folder, "Intermediates",
-                                      "Reach_Editing", "Inputs", "Points_Merge.shp")
-        merge_edit_location = os.path.join(watershed_folder, "Intermediates",
-                                           "Reach_Editing", "Outputs", "Points_Merge_To_Edit.shp")
-        arcpy.Merge_management(points_list, merge_location)
-        arcpy.Merge_management(points_list, merge_edit_location)
-        project_points.append(merge_location)
+        # Read the snapped points (and any fixed points), marking each one as TOR or BOR
+        template = os.path.join(points_folder, "Snapped", "TOR_Points_Snapped.shp")
+        fields = get_attribute_fields(template)
+        points_rows = []
+        for label in ["TOR", "BOR"]:
+            to_read = [os.path.join(points_folder, "Snapped", "{}_Points_Snapped.shp".format(label))]
+            if fixed_points:
+                fixed = os.path.join(points_folder, "Unsnapped_Fixed", "{}_Points_Fixed.shp".format(label))
+                if not is_empty(fixed):
+                    to_read.insert(0, fixed)
+            for points in to_read:
+                points_rows += [row + [label] for row in read_point_rows(points, fields)]
+
+        write_features(merge_location, "POINT", template, points_rows, [["TOR_BOR", "TEXT"]], "SHAPE@XY")
+
+        # Build each field reach straight from the network, as the path between its site's BOR and TOR points
+        reach_rows, unresolved = build_field_reaches(network, points_rows, fields.index("SiteID") + 1)
+        write_features(save_location, "POLYLINE", None, reach_rows, [["SiteID", get_field_type(template, "SiteID")]],
+                       spatial_reference=network)
+
+        arcpy.AddMessage("\t Built {} field reaches, {} sites could not be built".format(len(reach_rows),
+                                                                                         len(unresolved)))
+        list_to_csv(os.path.join(output_folder, "Unresolved_Reaches.csv"), [["SiteID", "Reason"]] + unresolved)
+
+        save_to_edit(watershed_folder, merge_location, save_location, True)
+        write_signature(signature_file, signature)
+
+    arcpy.AddMessage("Saving ProjectWide...")
+    make_projectwide(root_folder, project_points, project_networks)
 
-        # Dissolve the network
-        new_network = os.path.join(watershed_folder, "temp_network.shp")
-        temps_to_delete.append(new_network)
-        arcpy.Dissolve_management(network, new_network)
+    finish()
 
-        network = new_network
-        new_network = os.path.join(watershed_folder, "temp_network2.shp")
-        temps_to_delete.append(new_network)
 
-        # Split network at points
-        arcpy.SplitLineAtPoint_management(network, merge_location, new_network, "10 METERS")
-        network = new_network
+def read_point_rows(points, fields):
 
-        network_layer = "Network"
-        arcpy.MakeFeatureLayer_management(network, network_layer)
+    # Reads the location and the given fields of every point, leaving fields the points do not have empty
+    point_fields = get_attribute_fields(points)
+    with arcpy.da.SearchCursor(points, ["SHAPE@XY"] + point_fields) as cursor:
+        rows = [[row[0]] + [dict(zip(point_fields, row[1:])).get(field) for field in fields] for row in cursor]
+    return rows
 
-        # Make a new layer of only segments that intersect the field points
-        arcpy.SelectLayerByLocation_management\
-            (network_layer, 'INTERSECT', merge_location)
 
-        save_location = os.path.join(watershed_folder, "Intermediates",
-                                     "Reach_Editing", "Inputs", "Stream_Network_Segments.shp")
-        edit_location = os.path.join(watershed_folder, "Intermediates",
-                                     "Reach_Editing", "Outputs", "Stream_Network_Segments_To_Edit.shp")
-        arcpy.CopyFeatures_management(network_layer, save_location)
-        arcpy.CopyFeatures_management(network_layer, edit_location)
-        project_networks.append(save_location)
+def build_field_reaches(network, points_rows, site_index):
 
-    arcpy.AddMessage("Saving ProjectWide...")
-    make_projectwide(root_folder, project_points, project_networks)
+    # Turns the network into a graph once, then finds each point's spot along it (edge and measure). Reaches are paths
+    # between line ends, so the network is first split wherever streams join part way along a line.
+    network_segments, num_splits = split_network_at_junctions(read_network(network))
+    if num_splits:
+        arcpy.AddMessage("\t The stream network was not split at {} junctions, splitting it there".format(num_splits))
+    graph = build_network_graph(network_segments)
+    spatial_reference = arcpy.Describe(network).spatialReference
+    xy = np.array([row[0] for row in points_rows], dtype=float).reshape(-1, 2)
+    _, _, distance, edge, measure = snap_to_network(network_segments, xy[:, 0], xy[:, 1])
 
-    delete_temps(temps_to_delete)
-    finish()
+    sites = {}
+    for count, row in enumerate(points_rows):
+        sites.setdefault(row[site_index], {"TOR": [], "BOR": []})[row[-1]].append(count)
+
+    # Each site with one TOR and one BOR becomes the path along the network between them, from BOR to TOR
+    reach_rows = []
+    unresolved = []
+    for site_id, site_points in sorted(sites.items()):
+
+        if len(site_points["TOR"]) != 1 or len(site_points["BOR"]) != 1:
+            unresolved.append([site_id, "Site does not have exactly one TOR and one BOR point"])
+            continue
 
+        bor = site_points["BOR"][0]
+        tor = site_points["TOR"][0]
+        if max(distance[bor], distance[tor]) > reach_point_distance:
+            unresolved.append([site_id, "A point is not on the stream network"])
+            continue
 
-def save_fixed_points(stream_network, fixed_folder, watershed_folders):
+        path_length, pieces = find_network_path(graph, edge[bor], measure[bor], edge[tor], measure[tor])
+        if not pieces:
+            unresolved.append([site_id, "TOR and BOR are not connected along the stream network"])
+            continue
+        if path_length <= 0:
+            unresolved.append([site_id, "TOR and BOR are at the same spot"])
+            continue
+
+        vertices = get_path_vertices(network_segments, pieces)
+        line = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in vertices]), spatial_reference)
+        reach_rows.append([line, site_id])
+
+    return reach_rows, unresolved
+
+
+def save_to_edit(watershed_folder, merge_location, save_location, overwrite=False):
+
+    # Saves a duplicate of the points and segments that can be edited by hand
+    save_to_edit_folder(os.path.join(watershed_folder, "Intermediates", "Reach_Editing", "Outputs"),
+                        merge_location, save_location, overwrite)
+
+
+def save_to_edit_folder(edit_folder, merge_location, save_location, overwrite=False):
+
+    # The duplicates are only made once, so edits made to them are never overwritten (unless asked to)
+    for to_copy, edit_name in [[merge_location, "Points_Merge_To_Edit.shp"],
+                               [save_location, "Stream_Network_Segments_To_Edit.shp"]]:
+        edit_location = os.path.join(edit_folder, edit_name)
+        if overwrite or not arcpy.Exists(edit_location):
+            copy_dataset(to_copy, edit_location)
+
+
+def save_fixed_points(fixed_folder, watershed_folders):
 
     arcpy.AddMessage("\nSaving Fixed Points...\n")
 
@@ -150,22 +194,51 @@ def save_fixed_points(stream_network, fixed_folder, watershed_folders):
     tor_points = os.path.join(fixed_folder, "To_Fix_TOR.shp")
     bor_points = os.path.join(fixed_folder, "To_Fix_BOR.shp")
 
-    # 10m Snap to network (in case editing wasn't perfect
-    arcpy.Snap_edit(tor_points, [[stream_network, "EDGE", "10 Meters"]])
-    arcpy.Snap_edit(bor_points, [[stream_network, "EDGE", "10 Meters"]])
-
-    # For each watershed
-    for watershed_folder in watershed_folders:
-        # Get the boundary
-        boundary = os.path.join(watershed_folder, "Inputs", "Watershed_Boundary", "Watershed_Boundary.shp")
-
-        # Get the save loc for tor and bor
-        tor_save = os.path.join(watershed_folder, "Intermediates", "Points", "Unsnapped_Fixed", "TOR_Points_Fixed.shp")
-        bor_save = os.path.join(watershed_folder, "Intermediates", "Points", "Unsnapped_Fixed", "BOR_Points_Fixed.shp")
-
-        # Clip the points to that boundary
-        arcpy.Clip_analysis(tor_points, boundary, tor_save)
-        arcpy.Clip_analysis(bor_points, boundary, bor_save)
+    # Index every watershed boundary once, so the fixed points only need to be read once
+    watershed_index = build_polygon_index(read_watershed_boundaries(watershed_folders))
+
+    for label, points in [["TOR", tor_points], ["BOR", bor_points]]:
+
+        # Split the fixed points between the watersheds
+        fields = get_attribute_fields(points)
+        watershed_rows = [[] for _ in watershed_folders]
+        for number, row in partition_features(points, watershed_index, fields):
+            point = row[0].firstPoint
+            watershed_rows[number].append([(point.X, point.Y)] + row[1:])
+
+        # For each watershed
+        for watershed_folder, rows in zip(watershed_folders, watershed_rows):
+
+            network = os.path.join(watershed_folder, "Inputs", "Stream_Network", "Stream_Network.shp")
+            save_folder = os.path.join(watershed_folder, "Intermediates", "Points", "Unsnapped_Fixed")
+            fixed_save = os.path.join(save_folder, "{}_Points_Fixed.shp".format(label))
+            signature_file = os.path.join(save_folder, "{}_Fixed_Signature.txt".format(label))
+            cache_csv = os.path.join(save_folder, "{}_Fixed_Snap_Cache.csv".format(label))
+
+            # Only save the fixed points for this watershed if they (or the network) changed
+            network_hash = get_shapefile_hash(network, [".shp"])
+            signature = [network_hash, get_data_hash([fields] + rows)]
+            if read_signature(signature_file) == signature and arcpy.Exists(fixed_save):
+                continue
+
+            # Snap to network (in case editing wasn't perfect), only snapping points that are new or moved
+            id_index = fields.index("RchID") + 1
+            keys = [get_point_key(label, row[id_index], row[0][0], row[0][1]) for row in rows]
+            cache = read_snap_cache(cache_csv, network_hash)
+            snap_x, snap_y, snap_dist, _ = snap_with_cache(lazy_network(network), cache, keys,
+                                                           [row[0][0] for row in rows], [row[0][1] for row in rows])
+
+            for count, row in enumerate(rows):
+                if snap_dist[count] <= fixed_snap_distance:
+                    row[0] = (snap_x[count], snap_y[count])
+                # Keep the XY fields up to date with where the point now is
+                for xy_count, xy_field in enumerate(["POINT_X", "POINT_Y"]):
+                    if xy_field in fields:
+                        row[fields.index(xy_field) + 1] = row[0][xy_count]
+
+            write_features(fixed_save, "POINT", points, rows, shape_field="SHAPE@XY")
+            write_snap_cache(cache_csv, network_hash, dict((key, cache[key]) for key in keys))
+            write_signature(signature_file, signature)
 
     # Rename fixed project wide
     arcpy.Rename_management(tor_points, "TOR_Points_Fixed.shp")
@@ -176,10 +249,12 @@ def make_projectwide(root_folder, points, networks):
     save_folder = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Reach_Editing", "Inputs")
     to_edit_folder = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Reach_Editing", "Outputs")
 
-    arcpy.Merge_management(networks, os.path.join(save_folder, "Stream_Network_Segments.shp"))
-    arcpy.Merge_management(points, os.path.join(save_folder, "Points_Merge.shp"))
-    arcpy.Merge_management(networks, os.path.join(to_edit_folder, "Stream_Network_Segments_To_Edit.shp"))
-    arcpy.Merge_management(points, os.path.join(to_edit_folder, "Points_Merge_To_Edit.shp"))
+    # Merge once, then duplicate the merged files to be edited
+    merge_location = os.path.join(save_folder, "Points_Merge.shp")
+    save_location = os.path.join(save_folder, "Stream_Network_Segments.shp")
+    arcpy.Merge_management(networks, save_location)
+    arcpy.Merge_management(points, merge_location)
+    save_to_edit_folder(to_edit_folder, merge_location, save_location, True)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,8 @@
 import arcpy
 import os
 from collections import Counter
-from PNET_Functions import get_watershed_folders, delete_old, \
-    finish, delete_temps, remove_fields, attribute_table_to_list, get_field_index
+from PNET_Functions import get_watershed_folders, delete_old, finish, export_features, get_attribute_fields, \
+    write_features, list_to_csv
 
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 4
@@ -16,6 +16,9 @@ from PNET_Functions import get_watershed_folders, delete_old, \
 
 # The folder containing all watershed folders
 root_folder = arcpy.GetParameterAsText(0)
+# Reaches without a known SiteID (drawn or redrawn by hand) take the SiteID of the TOR and BOR points within this
+# distance (m) of them
+point_match_distance = 1
 
 
 def main():
@@ -25,7 +28,6 @@ def main():
 
     watershed_folders = get_watershed_folders(root_folder)
     delete_old(os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Reach_Editing", "Outputs"))
-    temps_to_delete = []
     to_merge_points = []
     to_merge_reaches = []
 
@@ -40,127 +42,83 @@ def main():
         stream_seg = os.path.join(input_folder, "Stream_Network_Segments.shp")
         points = os.path.join(input_folder, "Points_Merge.shp")
 
-        stream_seg_copy = os.path.join(input_folder, "Stream_Network_Segments_To_Edit_Temp.shp")
-        points_copy = os.path.join(input_folder, "Points_Merge_To_Edit_Temp.shp")
-
-        temps_to_delete.append(stream_seg_copy)
-        temps_to_delete.append(points_copy)
-
-        arcpy.Copy_management(stream_seg, stream_seg_copy)
-        arcpy.Copy_management(points, points_copy)
-
-        stream_seg = stream_seg_copy
-        points = points_copy
-
-        # Spatial jon stream network segments by points
-
-        fields_to_remove = ["TARGET_FID", "JOIN_FID", "Join_Count"]
-
-        spatial_joined = os.path.join(input_folder, "Spatial_Joined_Temp.shp")
-        temps_to_delete.append(spatial_joined)
-        remove_fields(fields_to_remove, stream_seg)
-        arcpy.SpatialJoin_analysis(stream_seg, points, spatial_joined, "JOIN_ONE_TO_MANY")
-
-        # Get an attribute table list of the joined shapefile to analyze
-        stream_seg_list = attribute_table_to_list(spatial_joined)
-        reach_id_index = get_field_index("TARGET_FID", spatial_joined)
-        point_id_index = get_field_index("SiteID", spatial_joined)
-        tor_bor_index = get_field_index("TOR_BOR", spatial_joined)
-
-        new_list = split_list_by_id(stream_seg_list, reach_id_index)
-        to_delete_list = []
-        keep_points_list = []
-
-        # Check which segments we need to delete
-        for segment in new_list:
-            if delete_segment(segment, point_id_index, tor_bor_index, reach_id_index):
-                to_delete_list.append(segment[0][reach_id_index])
-            else:
-                keep_points_list.append(segment[0][point_id_index])
-
-        segments_layer = "Segments"
-        arcpy.MakeFeatureLayer_management(stream_seg, segments_layer)
-
-        # Delete the segments we need to from initial segments
-        for to_delete in to_delete_list:
-            arcpy.SelectLayerByAttribute_management(segments_layer, 'ADD_TO_SELECTION', 'FID = {}'.format(to_delete))
-
-        # Save the reaches we want to keep
-        arcpy.SelectLayerByAttribute_management(segments_layer, 'SWITCH_SELECTION')
+        # Read every reach, and the SiteID of every point and whether it is a TOR or BOR
+        reach_fields = get_attribute_fields(stream_seg)
+        site_index = reach_fields.index("SiteID") + 1
+        with arcpy.da.SearchCursor(stream_seg, ["SHAPE@"] + reach_fields) as cursor:
+            reach_rows = [list(row) for row in cursor]
+        with arcpy.da.SearchCursor(points, ["SiteID", "TOR_BOR", "SHAPE@"]) as cursor:
+            point_rows = [list(row) for row in cursor]
+        point_sites = [row[:2] for row in point_rows]
+
+        # Reaches whose SiteID isn't one of the points' are matched to a site by the points they pass through
+        unmatched = match_reaches_to_sites(reach_rows, site_index, point_rows)
+        list_to_csv(os.path.join(output_folder, "Unmatched_Reaches.csv"), [["Reach", "Reason"]] + unmatched)
+        if unmatched:
+            arcpy.AddMessage("\t {} reaches could not be matched to a site, see Unmatched_Reaches.csv"
+                             .format(len(unmatched)))
+
+        # Only keep sites with exactly one reach, one TOR point and one BOR point
+        keep_sites = get_valid_sites([row[site_index] for row in reach_rows], point_sites)
+
+        # Save the reaches and points we want to keep
         reach_save_location = os.path.join(output_folder, "Field_Reaches.shp")
-        arcpy.CopyFeatures_management(segments_layer, reach_save_location)
+        write_features(reach_save_location, "POLYLINE", stream_seg,
+                       [row for row in reach_rows if row[site_index] in keep_sites])
         to_merge_reaches.append(reach_save_location)
 
-        # Save the points we want to keep
-        points_layer = "Points"
-        arcpy.MakeFeatureLayer_management(points, points_layer)
-
-        for to_keep in keep_points_list:
-            arcpy.SelectLayerByAttribute_management(points_layer, 'ADD_TO_SELECTION', 'SiteID = {}'.format(to_keep))
-
         point_save_location = os.path.join(output_folder, "Field_Points.shp")
-        arcpy.CopyFeatures_management(points_layer, point_save_location)
+        export_features(points, point_save_location, "SiteID", keep_sites)
         to_merge_points.append(point_save_location)
 
-        num_points = int(arcpy.GetCount_management(point_save_location)[0])
-        num_reaches = int(arcpy.GetCount_management(reach_save_location)[0])
-
-        # Check that everything was done correctly
-        if (num_points/2) != num_reaches:
-            arcpy.AddMessage("\t This watershed does not have one field reach per two field points!")
+        num_sites = len(set([site_id for site_id, _ in point_sites]))
+        arcpy.AddMessage("\t Kept {} of {} sites".format(len(keep_sites), num_sites))
 
     arcpy.AddMessage("Saving ProjectWide...")
     projectwide_folder = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Reach_Editing", "Outputs")
     arcpy.Merge_management(to_merge_points, os.path.join(projectwide_folder, "Field_Points.shp"))
     arcpy.Merge_management(to_merge_reaches, os.path.join(projectwide_folder, "Field_Reaches.shp"))
-    delete_temps(temps_to_delete)
     finish()
 
 
-def split_list_by_id(segment_list, id_index):
+def match_reaches_to_sites(reach_rows, site_index, point_rows):
 
-    to_return = []
-    current_seg = []
-    previous_id = segment_list[0][id_index]
+    # Gives each reach whose SiteID no point has the SiteID of the one site whose TOR and BOR points are both on it.
+    # Returns [reach number, reason] for every reach that could not be matched.
+    point_site_ids = set([row[0] for row in point_rows])
+    unmatched = []
+    for reach_num, row in enumerate(reach_rows):
+        if row[site_index] in point_site_ids:
+            continue
 
-    for segment in segment_list:
+        if row[0] is None:
+            unmatched.append([reach_num, "Reach has no shape"])
+            continue
 
-        # Adding a segment to the same reach
-        if segment[id_index] == previous_id:
-            current_seg.append(segment)
+        touching = Counter([(site_id, tor_bor) for site_id, tor_bor, point in point_rows
+                            if point is not None and row[0].distanceTo(point) <= point_match_distance])
+        sites = [site_id for site_id in point_site_ids
+                 if touching[(site_id, "TOR")] == 1 and touching[(site_id, "BOR")] == 1]
 
-        # Adding a new reach to the return list, then creating a new reach
+        if len(sites) == 1:
+            row[site_index] = sites[0]
+        elif not sites:
+            unmatched.append([reach_num, "Reach is not on the TOR and BOR points of any site"])
         else:
-            to_return.append(current_seg)
-            current_seg = [segment]
-            previous_id = segment[id_index]
-
-    # This makes sure that the final reach gets added, because it may be missed in the for loop
-    to_return.append(current_seg)
-
-    # Returns a list of reaches, which each contain a list of segments, which each contain a list of field values
-    return to_return
-
-
-def delete_segment(segment, point_id, tor_bor, reach_id):
+            unmatched.append([reach_num, "Reach is on the TOR and BOR points of more than one site"])
 
-    # If this segment is not touching exactly two points, delete it
-    if len(segment) != 2:
-        return True
+    return unmatched
 
-    # These hold data for the first and second point that the segment is touching
-    point_a = segment[0]
-    point_b = segment[1]
 
-    # If the two points the segment is touching are from different sites, delete it
-    if point_a[point_id] != point_b[point_id]:
-        return True
+def get_valid_sites(reach_sites, point_sites):
 
-    # Also delete if they are both TOR or both BOR
-    if point_a[tor_bor] == point_b[tor_bor]:
-        return True
+    # Counts how many reaches, TOR points and BOR points each site has
+    reach_counts = Counter(reach_sites)
+    point_counts = Counter([(site_id, tor_bor) for site_id, tor_bor in point_sites])
 
-    return False
+    # A site is only valid if it has exactly one of each
+    return set([site_id for site_id, count in reach_counts.items()
+                if count == 1 and point_counts[(site_id, "TOR")] == 1 and point_counts[(site_id, "BOR")] == 1])
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import arcpy
 import os
 from PNET_Functions import get_watershed_folders, delete_old, finish, \
-    delete_temps, write_fields_to_text
+    get_attribute_fields, get_field_type, write_features
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 5
 # Purpose:     Cleans up data, adds length field
@@ -15,6 +15,10 @@ from PNET_Functions import get_watershed_folders, delete_old, finish, \
 
 # A list of file locations pointing to each watershed's All_points folder
 root_folder = arcpy.GetParameterAsText(0)
+# The fields kept from the BOR points, for both the points and reaches
+keep_fields = ["SiteID", "RchID", "POINT_X", "POINT_Y", "SnapDist"]
+# The field that holds the length of each field reach
+length_field = "FldRchLen"
 
 
 def main():
@@ -24,8 +28,6 @@ def main():
 
     watershed_folders = get_watershed_folders(root_folder)
     projectwide_output = os.path.join(root_folder, "00_ProjectWide", "Intermediates", "Extraction", "Inputs")
-    temps_to_delete = []
-    keep_fields = ["Shape", "FID", "SiteID", "RchID", "POINT_X", "POINT_Y", "SnapDist"]
     to_merge_reaches = []
     to_merge_points = []
     delete_old(os.path.join(root_folder, "00_ProjectWide", "Inputs", "Parameters"))
@@ -40,59 +42,42 @@ def main():
         output_folder = os.path.join(watershed, "Intermediates", "Extraction", "Inputs")
         in_reaches = os.path.join(watershed, "Intermediates", "Reach_Editing", "Outputs", "Field_Reaches.shp")
         in_points = os.path.join(watershed, "Intermediates", "Reach_Editing", "Outputs", "Field_Points.shp")
-        points_temp = os.path.join(output_folder, "p_temp.shp")
-        reaches_temp = os.path.join(output_folder, "r_temp.shp")
-        reaches_joined = os.path.join(output_folder, "r_join.shp")
-        points_joined = os.path.join(output_folder, "p_join.shp")
-        temps_to_delete.extend([points_temp, reaches_temp, reaches_joined, points_joined])
         points_final = os.path.join(output_folder, "Field_Points_Clean.shp")
         reaches_final = os.path.join(output_folder, "Field_Reaches_Clean.shp")
 
-        # Add field for the length of the field reach
-        arcpy.Copy_management(in_reaches, reaches_temp)
-        field_to_add = "FldRchLen"
-        keep_fields.append(field_to_add)
-        field_names = [f.name for f in arcpy.ListFields(reaches_temp)]
+        # Read only the BOR points, as having two points per reach is now superfluous
+        point_fields = [field for field in keep_fields if field in get_attribute_fields(in_points)]
+        with arcpy.da.SearchCursor(in_points, ["SHAPE@XY", "TOR_BOR"] + point_fields) as cursor:
+            point_rows = [[row[0]] + list(row[2:]) for row in cursor if row[1] == "BOR"]
 
-        if field_to_add not in field_names:
-            arcpy.AddField_management(reaches_temp, field_to_add, "DOUBLE")
+        # Read the reaches, along with their lengths in meters (whatever units the reaches are stored in). Reaches
+        # without a shape have no length, which is saved as null.
+        with arcpy.da.SearchCursor(in_reaches, ["SHAPE@", "SiteID"]) as cursor:
+            reach_rows = [[shape, shape.getLength("PLANAR", "METERS") if shape is not None else None, site_id]
+                          for shape, site_id in cursor]
 
-        arcpy.CalculateField_management(reaches_temp, field_to_add, "!shape.length@meters!", "PYTHON_9.3", "")
+        # The points and reaches share SiteIDs, so each one gets the other's data through the SiteID
+        site_index = point_fields.index("SiteID") + 1
+        points_by_site = dict((row[site_index], row[1:]) for row in point_rows)
+        lengths_by_site = dict((row[2], row[1]) for row in reach_rows)
+        empty_values = [None] * len(point_fields)
 
-        # Reduce points to only BOR points
-        points_layer = "Points"
-        arcpy.MakeFeatureLayer_management(in_points, points_layer)
-        arcpy.SelectLayerByAttribute_management(points_layer, 'NEW_SELECTION', "\"TOR_BOR\" = \'BOR\'")
-        arcpy.CopyFeatures_management(points_layer, points_temp)
-
-        # Add all point data to the reaches
-        arcpy.SpatialJoin_analysis(reaches_temp, points_temp, reaches_joined, "JOIN_ONE_TO_ONE")
-
-        # Add all reach data to the points
-        arcpy.SpatialJoin_analysis(points_temp, reaches_temp, points_joined, "JOIN_ONE_TO_ONE")
-
-        # Only keep fields we need
-        shapes = [points_joined, reaches_joined]
-        for shape in shapes:
-
-            # Removes all fields from the shapefile that are not in the above list of fields to keep
-            field_names = [f.name for f in arcpy.ListFields(shape)]
-            delete_fields = []
-            for field in field_names:
-                if field not in keep_fields:
-                    delete_fields.append(field)
-
-            arcpy.DeleteField_management(shape, delete_fields)
+        add_fields = [[field, get_field_type(in_points, field)] for field in point_fields] + [[length_field, "DOUBLE"]]
 
         # Save the points and reaches
-        to_merge_points.append(arcpy.CopyFeatures_management(points_joined, points_final))
-        to_merge_reaches.append(arcpy.CopyFeatures_management(reaches_joined, reaches_final))
+        write_features(points_final, "POINT", None,
+                       [row + [lengths_by_site.get(row[site_index])] for row in point_rows],
+                       add_fields, "SHAPE@XY", spatial_reference=in_points)
+        write_features(reaches_final, "POLYLINE", None,
+                       [[row[0]] + points_by_site.get(row[2], empty_values) + [row[1]] for row in reach_rows],
+                       add_fields, spatial_reference=in_reaches)
+        to_merge_points.append(points_final)
+        to_merge_reaches.append(reaches_final)
 
     arcpy.AddMessage("Saving Projectwide...")
     arcpy.Merge_management(to_merge_points, os.path.join(projectwide_output, "Field_Points_Clean"))
     arcpy.Merge_management(to_merge_reaches, os.path.join(projectwide_output, "Field_Reaches_Clean"))
 
-    delete_temps(temps_to_delete)
     finish()
 
 
@@ -1,7 +1,8 @@
 import arcpy
 import os
 from PNET_Functions import get_watershed_folders, delete_old, finish, get_folder_list, \
-    is_empty, write_fields_to_text, parse_multistring
+    write_fields_to_text, parse_multistring, build_polygon_index, read_watershed_boundaries, \
+    partition_to_outputs, get_shapefile_hash, list_to_csv, get_data_network_directory
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 6
 # Purpose:     Takes as many different full runs as needed and puts them in a folder's structure
@@ -25,7 +26,6 @@ def main():
 
     watershed_folders = get_watershed_folders(root_folder)
     projectwide_output = os.path.join(root_folder, "00_ProjectWide", "Inputs", "Data_Networks")
-    projectwide_network = os.path.join(root_folder, "00_ProjectWide",  "Inputs", "Stream_Network", "Stream_Network.shp")
     delete_old(projectwide_output)
     total_count = len(data_networks_list_in)
 
@@ -46,35 +46,44 @@ def main():
         # Clear old data
         delete_old(os.path.join(watershed, "Inputs", "Data_Networks"))
 
+    # Index every watershed boundary once, so each data network only needs to be read once
+    watershed_index = build_polygon_index(read_watershed_boundaries(watershed_folders))
+
+    # A table of every slice, so that later steps know which slices exist without opening them
+    directory = [["Network", "Watershed", "Count", "XMin", "YMin", "XMax", "YMax", "Hash"]]
+
     for current_count, network_data in enumerate(sorted_list):
 
         name = network_data[0]
         network = network_data[1]
         arcpy.AddMessage("\nSaving {} Files ({}/{})...".format(name, current_count+1, total_count))
 
-        if '.shp' not in name:
-            name += '.shp'
-
-        for watershed in watershed_folders:
+        # Split the data network between the watersheds in a single pass
+        slices = [os.path.join(watershed, "Inputs", "Data_Networks", name + ".shp") for watershed in watershed_folders]
+        geometry_type = arcpy.Describe(network).shapeType.upper()
+        counts, extents = partition_to_outputs(network, watershed_index, slices, geometry_type)
 
-            arcpy.AddMessage("\tStarting " + watershed + "...")
+        to_merge = []
+        for watershed, network_slice, count, extent in zip(watershed_folders, slices, counts, extents):
 
-            # Get network to clip by
-            old_stream_network = os.path.join(watershed, "Inputs", "Stream_Network", "Stream_Network.shp")
+            # Don't keep an empty shapefile
+            if count == 0:
+                arcpy.AddMessage("\tDid not save {}, as it was empty".format(network_slice))
+                arcpy.Delete_management(network_slice)
+                directory.append([name, os.path.basename(watershed), 0, "", "", "", "", ""])
+                continue
 
-            # Clip the current data network to this watershed
-            new_network_save = os.path.join(watershed, "Inputs", "Data_Networks", name)
-            arcpy.Clip_analysis(network, old_stream_network, new_network_save)
-
-
-            # Don't create an empty shapefile
-            if is_empty(new_network_save):
-                arcpy.AddMessage("Did not save {}, as it was empty".format(new_network_save))
-                arcpy.Delete_management(new_network_save)
+            arcpy.AddSpatialIndex_management(network_slice)
+            directory.append([name, os.path.basename(watershed), count] + extent + [get_shapefile_hash(network_slice)])
+            to_merge.append(network_slice)
 
         arcpy.AddMessage("\tSaving Projectwide...")
-        new_network_save = os.path.join(projectwide_output, name)
-        arcpy.Clip_analysis(network, projectwide_network, new_network_save)
+        if to_merge:
+            new_network_save = os.path.join(projectwide_output, name + ".shp")
+            arcpy.Merge_management(to_merge, new_network_save)
+            arcpy.AddSpatialIndex_management(new_network_save)
+
+    list_to_csv(get_data_network_directory(root_folder), directory)
 
     finish()
 
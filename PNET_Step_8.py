@@ -1,6 +1,7 @@
 import arcpy
 import os
-from PNET_Functions import get_watershed_folders, delete_old, finish, get_folder_list, is_empty, create_csv, get_fields
+from PNET_Functions import get_watershed_folders, delete_old, finish, is_empty, create_csv, \
+    read_data_network_directory, get_data_network_slices, get_attribute_fields, get_field_definitions, write_features
 
 # -------------------------------------------------------------------------------
 # Name:        PNET Step 8
@@ -23,63 +24,31 @@ def main():
     projectwide_output = os.path.join(root_folder, "00_ProjectWide", "Outputs", "Extracted_Data")
     delete_old(projectwide_output)
     to_merge_points = []
-    req_fields = ["RchID", "FID", "Shape"]
+    directory = read_data_network_directory(root_folder)
 
     # This loops for each watershed folder
     for watershed in watershed_folders:
         arcpy.AddMessage("Working on {}...".format(watershed))
 
         # Initialize list of all unique data networks within this watershed
-        point_list = get_data_points(watershed)
+        point_list = get_data_points(watershed, directory)
         output_folder = os.path.join(watershed, "Outputs", "Extracted_Data")
         delete_old(output_folder)
 
-        # Create temporary shapefiles to store spatially joined data
-        all_joined = os.path.join(output_folder, "temp.shp")
+        if not point_list:
+            arcpy.AddMessage("\t No extracted data in this watershed, skipping")
+            continue
 
-        # Join the first and second network's data together, and store them into a temporary shapefile
-        arcpy.AddMessage("\t Merging first points...")
-
-        arcpy.Copy_management(point_list[0], all_joined)
-        all_fields = get_fields(all_joined)
-        for field in req_fields:
-            if field in all_fields:
-                all_fields.remove(field)
-
-        point_list.pop(0)
-
-        # Check to make sure there are still networks to join
-        if len(point_list) > 0:
-
-            # This repeats for each of the two remaining networks
-            for data in point_list:
-
-                arcpy.AddMessage("\t\tMerging more points...")
-                data_temp = os.path.join(output_folder, "data_temp.shp")
-                arcpy.Copy_management(data, data_temp)
-                data = data_temp
-                remove_existing_fields(all_fields, data)
-
-                # Join the current network to the previous network containing all other data
-                arcpy.JoinField_management(all_joined, "RchID", data, "RchID")
-                arcpy.DeleteField_management(all_joined, "RchID_1")
-                all_fields = get_fields(all_joined)
-                for field in req_fields:
-                    if field in all_fields:
-                        all_fields.remove(field)
-
-        # Save the output into the correct folder
-        save = arcpy.Copy_management(all_joined,
-                                     os.path.join(output_folder, "Extraction_Merge_Points.shp"))
+        # Join every network's data onto the first network's points, and save them all at once
+        arcpy.AddMessage("\t Merging {} data networks...".format(len(point_list)))
+        save = os.path.join(output_folder, "Extraction_Merge_Points.shp")
+        rows, add_fields = join_data_points(point_list)
+        write_features(save, "POINT", point_list[0], rows, add_fields, "SHAPE@XY")
 
         to_merge_points.append(save)
 
         create_csv(os.path.join(output_folder, "All_Data.csv"), save)
 
-        # Delete both temp shapefiles
-        arcpy.Delete_management(all_joined)
-        arcpy.Delete_management(data_temp)
-
     arcpy.AddMessage("Working on Projectwide...")
 
     make_csv = arcpy.Merge_management(to_merge_points,
@@ -88,39 +57,48 @@ def main():
     finish()
 
 
-def get_data_points(watershed_folder):
+def join_data_points(point_list):
 
-    # Gets a list of all network shapefile locations
-    to_return = []
-    network_folder = os.path.join(watershed_folder, "Intermediates", "Extraction", "Outputs")
-    data_network_list = get_folder_list(network_folder, False)
+    # Joins the data of every network onto the points of the first network by RchID. Only reaches in the first network
+    # are kept, and reaches missing from another network have no data for it. If networks share a field, the first
+    # network in the list keeps it. Returns the joined rows, and the fields that were added to the first network's.
+    all_fields = get_attribute_fields(point_list[0])
+    rch_index = all_fields.index("RchID") + 1
+    with arcpy.da.SearchCursor(point_list[0], ["SHAPE@XY"] + all_fields) as cursor:
+        rows = [row for row in cursor]
 
-    for folder in data_network_list:
+    add_fields = []
+    for data in point_list[1:]:
 
-        for r, d, f in os.walk(folder):
-            for file in f:
-                # This line makes sure it is a shapefile
-                if '.shp' in file and 'Reaches' not in file and '.xml' not in file and '.lock' not in file:
-                    to_return.append(os.path.join(r, file))
-    to_keep = []
-    for file in to_return:
-        if not is_empty(file):
-            to_keep.append(file)
+        # Only fields that no earlier network has are joined
+        new_fields = [field for field in get_attribute_fields(data) if field not in all_fields]
+        all_fields += new_fields
+        add_fields += get_field_definitions(data, new_fields)
 
-    return to_keep
+        # If a reach is in a network more than once, the first one is used
+        data_by_reach = {}
+        with arcpy.da.SearchCursor(data, ["RchID"] + new_fields) as cursor:
+            for row in cursor:
+                data_by_reach.setdefault(row[0], row[1:])
+
+        missing = (None,) * len(new_fields)
+        rows = [row + data_by_reach.get(row[rch_index], missing) for row in rows]
+
+    return rows, add_fields
 
 
-def remove_existing_fields(all_fields_list, shapefile):
+def get_data_points(watershed_folder, directory):
 
-    # Removes all fields tht are already part of the merged shapefile
-    cur_fields = get_fields(shapefile)
-    deleted_fields = []
-    for cur_field in cur_fields:
-        if cur_field in all_fields_list:
-            arcpy.DeleteField_management(shapefile, cur_field)
-            deleted_fields.append(cur_field)
+    # Gets the extracted points of every data network that has data in this watershed
+    to_keep = []
+    network_folder = os.path.join(watershed_folder, "Intermediates", "Extraction", "Outputs")
 
-    return deleted_fields
+    for name, _ in get_data_network_slices(root_folder, watershed_folder, directory):
+        points = os.path.join(network_folder, name, "{}_Points_Extracted.shp".format(name))
+        if arcpy.Exists(points) and not is_empty(points):
+            to_keep.append(points)
+
+    return to_keep
 
 
 if __name__ == "__main__":
@@ -2,7 +2,8 @@ import arcpy
 import os
 import shutil
 from PNET_Functions import get_watershed_folders, delete_old, create_csv,\
-    get_fields, csv_to_list, parse_multistring, make_folder
+    csv_to_list, parse_multistring, make_folder, load_field_database, get_database_rows, \
+    get_database_numbers, save_database_subset, write_features, max_point_fields, csv_headers
 import scipy.stats as stat
 import numpy as np
 import matplotlib.pyplot as plt
@@ -24,6 +25,9 @@ field_db = arcpy.GetParameterAsText(1)
 # CSV to set field data from instead (optional, expects headers)
 input_field_csv = arcpy.GetParameterAsText(2)
 
+# The fields made for each compared pair: PNET value, field value, difference, percent difference and ratio
+metric_prefixes = ["pn_", "fd_", "df_", "pf_", "ro_"]
+
 
 
 def main():
@@ -34,10 +38,13 @@ def main():
     # Setup projectwide data
 
     projectwide_output = make_folder(os.path.join(root_folder, "00_ProjectWide", "Outputs", "Comparisons"), "Numerical")
-    save_db(field_db, os.path.join(root_folder, "00_ProjectWide"))
-    delete_old(projectwide_output)
+    projectwide_db = save_db(field_db, os.path.join(root_folder, "00_ProjectWide"))
+
+    # The field database is read once, and each watershed only looks up its own reaches. It is read from the
+    # projectwide copy, which Step 10 reads too, so both steps share one cache of it.
+    store = load_field_database(projectwide_db, get_db_cache(projectwide_db))
 
-    keep_fields = ["FID", "Shape", "POINT_X", "POINT_Y", "SnapDist", "FldRchLen",
+    keep_fields = ["POINT_X", "POINT_Y", "SnapDist", "FldRchLen",
                    "EcoRgn_L4" ,"EcoRgn_L3" ,"HUC8" ,"NAME" ,"StreamName",
                    "PRECIP", "DRAREA", "iGeo_ElMax", "iGeo_ElMin"]
 
@@ -46,11 +53,17 @@ def main():
     # Set the field lists to the values from the fields value
     pnet_fields, field_db_fields, new_fields_initial = read_field_csv(input_field_csv)
 
+    # The pairs each watershed can compare are found from the headers of its PNET output. Every watershed is checked
+    # before any are written, so one with too many fields doesn't stop the run partway through.
+    watershed_pairs = {}
     for watershed in watershed_folders:
+        pnet_headers = csv_headers(os.path.join(watershed, "Outputs", "Extracted_Data", "All_Data.csv"))
+        pairs = get_pairs(pnet_headers, store, pnet_fields, field_db_fields, new_fields_initial)
+        check_field_count(watershed, pnet_headers, keep_fields, pairs)
+        watershed_pairs[watershed] = pairs
+    delete_old(projectwide_output)
 
-        old_pnet_fields = pnet_fields
-        old_field_db_fields = field_db_fields
-        old_new_fields_initial = new_fields_initial
+    for watershed in watershed_folders:
 
         arcpy.AddMessage("Working on {}...".format(watershed))
         arcpy.AddMessage("\t Combining Data...")
@@ -65,194 +78,118 @@ def main():
         # Get data from the PNET output
         pnet_data_list = csv_to_list(watershed_pnet)
 
-        # Find certain PNET indexes in the PNET output
-        id_pnet = pnet_data_list[0].index("""RchID""")
-        pnet_indexes = []
-        missing_field_indexes = []
-        for pnet_field in old_pnet_fields:
-            if pnet_field in pnet_data_list[0]:
-                pnet_indexes.append(pnet_data_list[0].index(pnet_field))
-            else:
-                missing_field_indexes.append(old_pnet_fields.index(pnet_field))
-
-        # remove headers
-        pnet_data_list.pop(0)
-
-        # Create a list with only necessary data
-        pnet_compare_list = []
-        for row in pnet_data_list:
-            to_add = []
-            # Add id column
-            to_add.append(row[id_pnet])
-            # Add any other columns
-            for index in pnet_indexes:
-                to_add.append(row[index])
-            pnet_compare_list.append(to_add)
-
-        # Get the CSV with Field data
-        watershed_db = save_db(field_db, watershed)
-
-        # Get data from the field database
-        field_data_list = csv_to_list(watershed_db)
-
-        # Find certain field indexes in the field database
-        id_field_db = field_data_list[0].index("""RchID""")
-        field_indexes_db = []
-        for field_db_field in old_field_db_fields:
-            if old_field_db_fields.index(field_db_field) not in missing_field_indexes:
-                field_indexes_db.append(field_data_list[0].index(field_db_field))
-
-        # remove headers
-        field_data_list.pop(0)
-
-        # Create a list with only necessary data
-        field_compare_list = []
-        for row in field_data_list:
-            to_add = []
-            # Add id column
-            to_add.append(row[id_field_db])
-            # Add any other columns
-            for index in field_indexes_db:
-                to_add.append(row[index])
-            field_compare_list.append(to_add)
-
-        # Make list of new fields
-        new_fields = ["""RchID"""]
-        for new_field in old_new_fields_initial:
-            if old_new_fields_initial.index(new_field) not in missing_field_indexes:
-                # make sure the field can fit into an arcmap field
-                # This is where PNET data will go
-                new_fields.append("pn_" + new_field[:7])
-                # This is where field database data will go
-                new_fields.append("fd_" + new_field[:7])
-                # This is where actual difference data will go
-                #new_fields.append("df_" + new_field[:7])
-                # This is where percent difference data will go
-                #new_fields.append("pf_" + new_field[:7])
-                # This is where ratio data will go
-                #new_fields.append("ro_" + new_field[:7])
+        pnet_headers = pnet_data_list.pop(0)
+        pairs = watershed_pairs[watershed]
 
+        # Find the field database row of each PNET reach, and save the field data of this watershed's reaches
+        rch_ids = [row[pnet_headers.index("""RchID""")] for row in pnet_data_list]
+        db_rows = get_database_rows(store, rch_ids)
+        save_database_subset(store, db_rows, os.path.join(watershed, "Inputs", "Database", "Field_Database.csv"))
 
-        # Perform data comparisons
+        # Make list of new fields, and compare every pair of fields at once, with NaN wherever data is missing
+        arcpy.AddMessage("\t Creating New Fields...")
+        new_fields = ["""RchID"""]
+        metrics = []
+        for pnet_index, field_db_field, new_field in pairs:
+            # make sure the field can fit into an arcmap field
+            new_fields += [prefix + new_field[:7] for prefix in metric_prefixes]
+            pnet_values = to_float_array([row[pnet_index] for row in pnet_data_list])
+            field_values = get_database_numbers(store, field_db_field, db_rows)
+            metrics += compare_values(pnet_values, field_values)
+
+        # Missing data is only turned into -999 now, as that is how it is saved in the shapefile
+        metrics = np.column_stack(metrics) if metrics else np.zeros((len(pnet_data_list), 0))
+        metrics = np.where(np.isfinite(metrics), metrics, -999).tolist()
 
-        both_compare_list = [new_fields]
+        # Add in data for each of the other PNET fields
+        keep_indexes = [pnet_headers.index(add_field) for add_field in keep_fields if add_field in pnet_headers]
+        both_compare_list = [[pnet_headers[index] for index in keep_indexes] + new_fields]
+        for row, rch_id, row_metrics in zip(pnet_data_list, rch_ids, metrics):
+            both_compare_list.append([row[index] for index in keep_indexes] + [rch_id] + row_metrics)
 
-        arcpy.AddMessage("\t Creating New Fields...")
+        # The other PNET fields and RchID are saved as text, and the comparisons as numbers
+        num_text = len(keep_indexes) + 1
+        schema = [[field, "TEXT"] for field in both_compare_list[0][:num_text]] + \
+                 [[field, "FLOAT"] for field in both_compare_list[0][num_text:]]
 
-        for pnet_row in pnet_compare_list:
+        # Each point is in the same place as the extracted point it came from
+        template = os.path.join(watershed, "Outputs", "Extracted_Data", "Extraction_Merge_Points.shp")
+        with arcpy.da.SearchCursor(template, ["SHAPE@XY"]) as cursor:
+            rows = [[search_row[0]] + row for row, search_row in zip(both_compare_list[1:], cursor)]
 
-            new_row = []
-            # Get the ID of the current row
-            current_site = pnet_row[0]
+        arcpy.AddMessage("\t Creating Shapefile...")
 
+        # Create the shapefile with every field at once, and add in the data
+        comparison_points = write_features(os.path.join(watershed_output, "Numerical_Comparison_Points.shp"), "POINT",
+                                           None, rows, schema, "SHAPE@XY", spatial_reference=template)
 
-            # Find the corresponding row in the field data list
-            for db_row_num, db_row in enumerate(field_compare_list):
-                # If the two site are the same
-                if db_row[0] == current_site:
-                    field_row = db_row
-                    break
+        to_merge.append(comparison_points)
 
-            # Add the reach ID to our new row
-            new_row.append(pnet_row[0])
+        # Save as CSV
+        create_csv(os.path.join(watershed_output, "Numerical_Comparison_Data.csv"), comparison_points)
 
-            # Prepare to iterate through each column of data, skipping rchID
-            pnet_iter = iter(pnet_row)
-            field_iter = iter(field_row)
-            next(pnet_iter)
-            next(field_iter)
+    arcpy.AddMessage('Saving ProjectWide...')
+    merged = arcpy.Merge_management(to_merge, os.path.join(projectwide_output, "Numerical_Comparison_Points.shp"))
+    create_csv(os.path.join(projectwide_output, "Numerical_Comparison_Data.csv"), merged)
 
-            for pnet_data, field_data, in zip(pnet_iter, field_iter):
 
-                # Make sure that the data is not missing
-                if pnet_data != "" and field_data != "":
+def save_db(database, main_folder):
+    # The copy keeps the database's modified time, so the cache of it is still used after it is copied again
+    save_loc = os.path.join(main_folder, "Inputs", "Database", "Field_Database.csv")
+    shutil.copy2(database, save_loc)
+    return save_loc
 
-                    # Add data into the new row
-                    pnet_num = float(pnet_data)
-                    field_num = float(field_data)
-                    new_row.append(pnet_num)
-                    new_row.append(field_num)
 
-                    # Add actual difference field
-                    #new_row.append(pnet_num-field_num)
+def to_float_array(values):
+    # Turns a column of data into numbers, with NaN for missing data
+    return np.array([float(value) if value != "" else np.nan for value in values], dtype=float)
 
-                    # Add percent difference field
-                    #if field_num > 0 or field_num < 0:
-                    #     if pnet_num > field_num:
-                    #        new_row.append((pnet_num-field_num)/pnet_num)
-                    #    else:
-                    #        new_row.append((field_num-pnet_num)/field_num)
-                    #     #Add ratio field
-                    #    new_row.append(float(pnet_num/field_num))
-                    #else:
-                    #    new_row.append(-999)
 
+def compare_values(pnet_values, field_values):
 
-                else:
-                    new_row += [-999, -999]
+    # Compares a PNET field to a field database field for every reach at once. Returns the PNET values, field values,
+    # difference, percent difference and ratio. If either value of a reach is missing, all of them are NaN.
+    missing = np.isnan(pnet_values) | np.isnan(field_values)
+    pnet_values = np.where(missing, np.nan, pnet_values)
+    field_values = np.where(missing, np.nan, field_values)
 
-            both_compare_list.append(new_row)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        difference = pnet_values - field_values
+        # The percent difference is relative to whichever value is larger
+        percent_difference = np.where(pnet_values > field_values, difference / pnet_values,
+                                      -difference / field_values)
+        ratio = pnet_values / field_values
 
-        # Add in data for each of the other PNET fields
-        pnet_data_list = csv_to_list(watershed_pnet)
-        for row_num, row in enumerate(both_compare_list):
-            # Add data from each PNET field
-            data_to_add = []
-            for add_field in keep_fields:
-                if add_field in pnet_data_list[0]:
-                    this_index = pnet_data_list[0].index(add_field)
-                    data_to_add.append(pnet_data_list[row_num][this_index])
-            both_compare_list[row_num] = data_to_add + row
-
-        # Create a new shapefile to hold data
-        template = os.path.join(watershed, "Outputs", "Extracted_Data", "Extraction_Merge_Points.shp")
-        comparison_points = arcpy.CreateFeatureclass_management(watershed_output, "Numerical_Comparison_Points.shp",
-                                                                "POINT", spatial_reference=template)
-
-        # Add in new fields to the shapefile
-        for count, (field, example) in enumerate(zip(both_compare_list[0], both_compare_list[1])):
-            arcpy.AddMessage("\t\t Adding Field {} ({}/{})...".format(field, count+1, len(both_compare_list[0])))
-            # Make sure we are not adding in any already existing default fields
-            shapefile_fields = get_fields(comparison_points)
-            if field not in shapefile_fields:
-                # Decide to add a text or float field
-                if isinstance(example, str):
-                    arcpy.AddField_management(comparison_points, field, "TEXT")
-                else:
-                    arcpy.AddField_management(comparison_points, field, "FLOAT")
-            elif count > 2:
-                arcpy.AddMessage("\t\t\t Reminder: All new name fields need to be unique within the first 7 characters")
-
-        # Skip headers
-        iter_list = iter(both_compare_list)
-        next(iter_list)
-
-        # remove useless field
-        arcpy.DeleteField_management(comparison_points, "Id")
+    # Percent difference and ratio have no meaning when the field value is zero
+    percent_difference[field_values == 0] = np.nan
+    ratio[field_values == 0] = np.nan
 
-        arcpy.AddMessage("\t Creating Shapefile...")
+    return [pnet_values, field_values, difference, percent_difference, ratio]
 
-        # Add in data to the shapefile
-        with arcpy.da.InsertCursor(comparison_points, '*') as inserter:
-            with arcpy.da.SearchCursor(template, '*') as searcher:
-                for row, search_row in zip(iter_list, searcher):
-                    row[1] = search_row[1]
-                    inserter.insertRow(row)
 
-        to_merge.append(comparison_points)
+def get_pairs(pnet_headers, store, pnet_fields, field_db_fields, new_fields):
+    # Find certain PNET indexes in the PNET output. Pairs where either field is missing are skipped.
+    pairs = []
+    for pnet_field, field_db_field, new_field in zip(pnet_fields, field_db_fields, new_fields):
+        if pnet_field in pnet_headers and field_db_field in store["columns"]:
+            pairs.append([pnet_headers.index(pnet_field), field_db_field, new_field])
+    return pairs
 
-        # Save as CSV
-        create_csv(os.path.join(watershed_output, "Numerical_Comparison_Data.csv"), comparison_points)
 
-    arcpy.AddMessage('Saving ProjectWide...')
-    merged = arcpy.Merge_management(to_merge, os.path.join(projectwide_output, "Numerical_Comparison_Points.shp"))
-    create_csv(os.path.join(projectwide_output, "Numerical_Comparison_Data.csv"), merged)
+def check_field_count(watershed, pnet_headers, keep_fields, pairs):
+    # Every pair adds a field for each metric, so too many pairs can't be saved in a shapefile
+    num_fields = len([field for field in keep_fields if field in pnet_headers]) + 1 + \
+        len(metric_prefixes) * len(pairs)
+    if num_fields > max_point_fields:
+        raise ValueError("Comparing {} pairs of fields in {} needs {} fields, but the comparison points can only have "
+                         "{}. Compare at most {} pairs at once.".format(
+                             len(pairs), os.path.basename(watershed), num_fields, max_point_fields,
+                             (max_point_fields - num_fields + len(metric_prefixes) * len(pairs)) //
+                             len(metric_prefixes)))
 
 
-def save_db(database, main_folder):
-    save_loc = os.path.join(main_folder, "Inputs", "Database", "Field_Database.csv")
-    shutil.copyfile(database, save_loc)
-    return save_loc
+def get_db_cache(saved_db):
+    return os.path.join(os.path.dirname(saved_db), "Field_Database_Cache.pkl")
 
 
 def is_csv(file):